@@ -0,0 +1,21 @@
+from kerckhoff.packages.operations.models import GoogleDriveFile, GoogleDriveTextFile
+
+
+def bench_from_listing(benchmark, drive_listing):
+    documents = [
+        item for item in drive_listing if not item["mimeType"].startswith("image/")
+    ]
+    benchmark(lambda: [GoogleDriveTextFile(item) for item in documents])
+
+
+def bench_to_json(benchmark, drive_files):
+    benchmark(lambda: [file.to_json() for file in drive_files])
+
+
+def bench_from_json(benchmark, drive_files):
+    serialized = [file.to_json() for file in drive_files]
+    benchmark(lambda: [GoogleDriveFile.from_json(item) for item in serialized])
+
+
+def bench_content_hash(benchmark, drive_files):
+    benchmark(lambda: [file.get_content_hash() for file in drive_files])
@@ -0,0 +1,9 @@
+from kerckhoff.packages.operations.utils import GoogleDocHTMLCleaner, html_to_text
+
+
+def bench_clean(benchmark, export_html):
+    benchmark(GoogleDocHTMLCleaner.clean, export_html)
+
+
+def bench_html_to_text(benchmark, export_html):
+    benchmark(html_to_text, GoogleDocHTMLCleaner.clean(export_html))
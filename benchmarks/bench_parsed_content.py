@@ -0,0 +1,33 @@
+import io
+
+from django.core.cache import cache
+
+from kerckhoff.packages.operations.models import FORMAT_AML, FORMAT_MD, ParsedContent
+
+
+def bench_aml(benchmark, aml_document):
+    benchmark.pedantic(
+        ParsedContent, args=(aml_document, FORMAT_AML), setup=cache.clear, rounds=20
+    )
+
+
+def bench_aml_cached(benchmark, aml_document):
+    ParsedContent(aml_document, FORMAT_AML)
+    benchmark(ParsedContent, aml_document, FORMAT_AML)
+
+
+def bench_aml_from_stream(benchmark, aml_document):
+    stream = io.StringIO(aml_document)
+    chunks = list(iter(lambda: stream.read(8192), ""))
+    benchmark.pedantic(
+        ParsedContent.from_stream,
+        args=(chunks, FORMAT_AML),
+        setup=cache.clear,
+        rounds=20,
+    )
+
+
+def bench_markdown(benchmark, markdown_document):
+    benchmark.pedantic(
+        ParsedContent, args=(markdown_document, FORMAT_MD), setup=cache.clear, rounds=20
+    )
@@ -0,0 +1,15 @@
+import io
+
+from kerckhoff.packages.operations.parser import Parser
+from kerckhoff.packages.operations.utils import decode_chunks
+
+
+def bench_parse(benchmark, aml_document):
+    benchmark(Parser().parse, aml_document)
+
+
+def bench_parse_stream(benchmark, aml_document):
+    encoded = aml_document.encode("utf-8")
+    stream = io.BytesIO(encoded)
+    chunks = list(iter(lambda: stream.read(8192), b""))
+    benchmark(lambda: Parser().parse_stream(decode_chunks(chunks)))
@@ -0,0 +1,69 @@
+import pytest
+from taggit.models import Tag
+
+from kerckhoff.packages.models import Package, PackageItem, PackageSet, PackageVersion
+from kerckhoff.packages.serializers import (
+    PackageItemSerializer,
+    PackageSerializer,
+    PackageSetSerializer,
+    PackageVersionSerializer,
+)
+from kerckhoff.users.models import User
+
+
+# The instances are never saved, and the queries the serializers would make are avoided,
+# so that only serialization is measured
+@pytest.fixture
+def user() -> User:
+    return User(id=1, username="joebruin", first_name="Joe", last_name="Bruin")
+
+
+@pytest.fixture
+def package_set(user) -> PackageSet:
+    return PackageSet(slug="flatpages", metadata={}, created_by=user)
+
+
+@pytest.fixture
+def package(package_set, user, drive_files) -> Package:
+    package = Package(
+        slug="flatpages.sports",
+        package_set=package_set,
+        created_by=user,
+        cached=[file.to_json() for file in drive_files],
+    )
+    package._prefetched_objects_cache = {"tags": Tag.objects.none()}
+    return package
+
+
+def bench_package_set(benchmark, package_set):
+    benchmark(lambda: PackageSetSerializer(package_set).data)
+
+
+def bench_package(benchmark, package):
+    benchmark(lambda: PackageSerializer(package).data)
+
+
+def bench_packages(benchmark, package):
+    packages = [package] * 50
+    benchmark(lambda: PackageSerializer(packages, many=True).data)
+
+
+def bench_package_version(benchmark, package, user):
+    version = PackageVersion(
+        id_num=1, title="v1", version_description="", package=package, created_by=user
+    )
+    benchmark(lambda: PackageVersionSerializer(version).data)
+
+
+def bench_package_items(benchmark, drive_files):
+    items = []
+    for file in drive_files:
+        item = PackageItem(
+            data_type=file.get_data_type(),
+            data=file.to_json(),
+            file_name=file.title,
+            mime_type=file.mimeType,
+        )
+        item._prefetched_objects_cache = {"tags": Tag.objects.none()}
+        items.append(item)
+    benchmark(lambda: PackageItemSerializer(items, many=True).data)
@@ -0,0 +1,74 @@
+import json
+import os
+import sys
+
+import configurations
+import pytest
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BENCHMARKS_DIR, "fixtures")
+SIZES = ("small", "medium", "large")
+
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "kerckhoff.config")
+os.environ.setdefault("DJANGO_CONFIGURATION", "Local")
+os.environ.setdefault("DJANGO_SECRET_KEY", "benchmarks")
+# Benchmarks run offline, against the local memory cache
+os.environ["CACHE_HOST"] = ""
+
+configurations.setup()
+
+
+def read_fixture(path: str) -> str:
+    with open(os.path.join(FIXTURES_DIR, path), encoding="utf-8") as f:
+        return f.read()
+
+
+@pytest.fixture(params=SIZES)
+def export_html(request) -> str:
+    """A Google Docs HTML export, see fixtures/generate.py"""
+    return read_fixture(f"exports/{request.param}.html")
+
+
+@pytest.fixture(params=SIZES)
+def aml_document(request) -> str:
+    return read_fixture(f"documents/{request.param}.aml")
+
+
+@pytest.fixture(params=SIZES)
+def markdown_document(request) -> str:
+    return read_fixture(f"documents/{request.param}.md")
+
+
+@pytest.fixture
+def drive_listing() -> list:
+    """The items of a Google Drive folder listing"""
+    return json.loads(read_fixture("drive_listing.json"))["items"]
+
+
+@pytest.fixture
+def drive_files(drive_listing) -> list:
+    """The files of the Google Drive listing as cached by Package.fetch_cache, with the
+    medium documents as the content of every text file"""
+    from kerckhoff.packages.operations.models import (
+        FORMAT_AML,
+        FORMAT_MD,
+        GoogleDriveImageFile,
+        GoogleDriveTextFile,
+    )
+    from kerckhoff.packages.operations.utils import GoogleDocHTMLCleaner
+
+    contents = {
+        FORMAT_AML: read_fixture("documents/medium.aml"),
+        FORMAT_MD: read_fixture("documents/medium.md"),
+    }
+    rich_text = GoogleDocHTMLCleaner.clean(read_fixture("exports/medium.html"))
+    files = []
+    for item in drive_listing:
+        if item["mimeType"].startswith("image/"):
+            files.append(GoogleDriveImageFile(item))
+            continue
+        text_file = GoogleDriveTextFile(item)
+        text_file.parse_content(contents.get(text_file.format, rich_text))
+        files.append(text_file)
+    return files
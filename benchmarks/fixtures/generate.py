@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""Generates the fixtures of the benchmarks
+
+Usage: ./benchmarks/fixtures/generate.py
+
+The fixtures are shaped like what Google Drive returns (file listings, HTML and plain
+text exports), and are generated from fixed seeds so that every run benchmarks the same
+data. They are committed, regenerating them changes the numbers compared against.
+"""
+import json
+import os
+import random
+
+FIXTURES_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Number of paragraphs of the documents of each size
+SIZES = {"small": 10, "medium": 100, "large": 300}
+# Number of items of the Google Drive listing
+LISTING_SIZE = 200
+
+WORDS = (
+    "the daily bruin news sports arts opinion campus students quad westwood "
+    "university regents tuition housing basketball football season game coach "
+    "professor research study library royce powell kerckhoff hall ackerman"
+).split()
+SPAN_STYLES = [
+    "color:#000000",
+    "font-weight:400",
+    "font-weight:700",
+    "text-decoration:none",
+    "text-decoration:underline",
+    "vertical-align:baseline",
+    "font-size:11pt",
+    "font-family:&quot;Arial&quot;",
+    "font-style:normal",
+    "font-style:italic",
+]
+
+
+def sentence(rnd: random.Random, min_words: int = 4, max_words: int = 20) -> str:
+    words = [rnd.choice(WORDS) for _ in range(rnd.randint(min_words, max_words))]
+    return " ".join(words).capitalize() + "."
+
+
+def paragraph(rnd: random.Random) -> str:
+    return " ".join(sentence(rnd) for _ in range(rnd.randint(1, 5)))
+
+
+def generate_export(paragraphs: int, seed: int) -> str:
+    """A Google Docs HTML export: paragraphs of spans styled inline with a few distinct
+    styles, and links through the Google redirect"""
+    rnd = random.Random(seed)
+    styles = [";".join(rnd.sample(SPAN_STYLES, rnd.randint(2, 6))) for _ in range(12)]
+    html = [
+        '<html><head><meta content="text/html; charset=UTF-8" http-equiv="content-type">'
+        '</head><body class="c4 c9">'
+    ]
+    for _ in range(paragraphs):
+        html.append('<p class="c%d">' % rnd.randint(0, 8))
+        for _ in range(rnd.randint(1, 6)):
+            text = sentence(rnd, 1, 12)
+            if rnd.random() < 0.1:
+                text = (
+                    '<a class="c2" href="https://www.google.com/url?q='
+                    'https://dailybruin.com/%d&amp;sa=D&amp;ust=1559000000000&amp;usg=AFQjCNE">'
+                    "%s</a>" % (rnd.randint(0, 999), text)
+                )
+            html.append('<span style="%s">%s</span>' % (rnd.choice(styles), text))
+        html.append("</p>")
+    html.append("</body></html>")
+    return "".join(html)
+
+
+def generate_aml(paragraphs: int, seed: int) -> str:
+    """An ArchieML story: metadata, a freeform body with embeds, related stories"""
+    rnd = random.Random(seed)
+    lines = [
+        "headline: " + sentence(rnd, 3, 10),
+        "subhead: " + sentence(rnd),
+        "author: Joe Bruin",
+        "{meta}",
+        "section: news",
+        "tags.primary: " + rnd.choice(WORDS),
+        "{}",
+        "",
+        "[+body]",
+    ]
+    for index in range(paragraphs):
+        lines.append(paragraph(rnd))
+        if index % 10 == 9:
+            lines.extend(
+                [
+                    "{.image}",
+                    "src: https://assets.dailybruin.com/images/%d.jpg" % index,
+                    "caption: " + sentence(rnd),
+                    "{}",
+                ]
+            )
+        if index % 25 == 24:
+            lines.extend(["[.list]", "* " + sentence(rnd), "* " + sentence(rnd), "[]"])
+    lines.extend(["[]", "", "[related]"])
+    for _ in range(max(1, paragraphs // 10)):
+        lines.extend(
+            [
+                "title: " + sentence(rnd, 3, 8),
+                "url: https://dailybruin.com/%d" % rnd.randint(0, 9999),
+                "summary: " + paragraph(rnd),
+                ":end",
+            ]
+        )
+    lines.extend(["[]", ":ignore", paragraph(rnd)])
+    return "\n".join(lines) + "\n"
+
+
+def generate_markdown(paragraphs: int, seed: int) -> str:
+    """A Markdown article with front matter, headings, lists and links"""
+    rnd = random.Random(seed)
+    lines = [
+        "---",
+        "title: " + sentence(rnd, 3, 10),
+        "author: Joe Bruin",
+        "tags: [news, campus]",
+        "---",
+        "",
+    ]
+    for index in range(paragraphs):
+        if index % 8 == 0:
+            lines.extend(["## " + sentence(rnd, 2, 6), ""])
+        text = paragraph(rnd)
+        if index % 3 == 0:
+            text += " Read [more](https://dailybruin.com/%d) **here**." % index
+        lines.extend([text, ""])
+        if index % 12 == 11:
+            lines.extend(["- " + sentence(rnd) for _ in range(3)] + [""])
+    return "\n".join(lines)
+
+
+def generate_listing(size: int, seed: int) -> dict:
+    """A page of files.list of the Google Drive v2 API for a package folder"""
+    rnd = random.Random(seed)
+    items = []
+    for index in range(size):
+        file_id = "1%032x" % rnd.getrandbits(128)
+        item = {
+            "id": file_id,
+            "selfLink": "https://www.googleapis.com/drive/v2/files/" + file_id,
+            "modifiedDate": "2019-05-%02dT%02d:%02d:%02d.%03dZ"
+            % (
+                rnd.randint(1, 28),
+                rnd.randint(0, 23),
+                rnd.randint(0, 59),
+                rnd.randint(0, 59),
+                rnd.randint(0, 999),
+            ),
+            "lastModifyingUser": {
+                "displayName": rnd.choice(["Joe Bruin", "Josie Bruin"])
+            },
+        }
+        if index % 3 == 0:
+            item.update(
+                {
+                    "title": "image-%d.jpg" % index,
+                    "mimeType": "image/jpeg",
+                    "alternateLink": "https://drive.google.com/file/d/%s/view"
+                    % file_id,
+                    "thumbnailLink": "https://lh3.googleusercontent.com/%s=s220"
+                    % file_id,
+                    "md5Checksum": "%032x" % rnd.getrandbits(128),
+                }
+            )
+        else:
+            item.update(
+                {
+                    "title": "file-%d.%s" % (index, rnd.choice(["aml", "md", "txt"])),
+                    "mimeType": "application/vnd.google-apps.document",
+                    "alternateLink": "https://docs.google.com/document/d/%s/edit"
+                    % file_id,
+                }
+            )
+        items.append(item)
+    return {"kind": "drive#fileList", "items": items}
+
+
+def write(path: str, content: str):
+    path = os.path.join(FIXTURES_DIR, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+
+
+def main():
+    for seed, (name, paragraphs) in enumerate(SIZES.items()):
+        write(f"exports/{name}.html", generate_export(paragraphs, seed))
+        write(f"documents/{name}.aml", generate_aml(paragraphs, seed))
+        write(f"documents/{name}.md", generate_markdown(paragraphs, seed))
+    write(
+        "drive_listing.json",
+        json.dumps(generate_listing(LISTING_SIZE, 0), indent=2, sort_keys=True) + "\n",
+    )
+
+
+if __name__ == "__main__":
+    main()
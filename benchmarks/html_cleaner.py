@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""Compares GoogleDocHTMLCleaner with the cleaner it replaced
+
+Usage: ./benchmarks/html_cleaner.py [exported.html ...]
+
+Cleans each given Google Docs HTML export (or the exports in fixtures/exports) with both
+cleaners, checks that their output is identical and prints their best timings.
+"""
+import os
+import re
+import sys
+import timeit
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "kerckhoff.config")
+os.environ.setdefault("DJANGO_CONFIGURATION", "Local")
+
+import configurations  # noqa: E402
+
+configurations.setup()
+
+from bleach.sanitizer import Cleaner  # noqa: E402
+from html5lib.filters.base import Filter  # noqa: E402
+
+from kerckhoff.packages.operations.utils import (  # noqa: E402
+    ATTRS,
+    STYLES,
+    TAGS,
+    GoogleDocHTMLCleaner,
+)
+
+
+# The previous cleaner, three chained filters applied after the bleach sanitizer
+class KeepOnlyInterestingSpans(Filter):
+    def _style_is_boring(self, prop, value):
+        boring_styles = {
+            "font-weight": ["400", "normal"],
+            "text-decoration": ["none"],
+            "font-style": ["normal"],
+        }
+
+        return value in boring_styles.get(prop, [])
+
+    def _reduce_to_interesting_styles(self, token):
+        styles = token["data"].get((None, "style"))
+        if styles is not None:
+            final_styles = ""
+            for prop, value in re.findall(r"([-\w]+)\s*:\s*([^:;]*)", styles):
+                if not self._style_is_boring(prop, value):
+                    final_styles += "%s:%s;" % (prop, value)
+            token["data"][(None, "style")] = final_styles
+            return final_styles
+        return ""
+
+    def __iter__(self):
+        # Was unset until the first dropped span, which failed on documents starting
+        # with an interesting span
+        drop_next_close = False
+        for token in Filter.__iter__(self):
+            is_span = token.get("name") == "span"
+            if token["type"] == "StartTag" and is_span:
+                if not token["data"]:
+                    drop_next_close = True
+                    continue
+
+                reduced_styles = self._reduce_to_interesting_styles(token)
+                if reduced_styles == "":
+                    drop_next_close = True
+                    continue
+            elif token["type"] == "EndTag" and is_span and drop_next_close:
+                drop_next_close = False
+                continue
+            yield (token)
+
+
+class ConvertPTagsToNewlines(Filter):
+    NEWLINE_TOKEN = {"type": "Characters", "data": "\n"}
+
+    def __iter__(self):
+        for token in Filter.__iter__(self):
+            if token["type"] == "StartTag" and token["name"] == "p":
+                continue
+            elif token["type"] == "EndTag" and token["name"] == "p":
+                yield (self.NEWLINE_TOKEN)
+                continue
+            yield (token)
+
+
+class RemoveGoogleTrackingFromHrefs(Filter):
+    def __iter__(self):
+        for token in Filter.__iter__(self):
+            if token["type"] == "StartTag" and token["name"] == "a" and token["data"]:
+                url = token["data"].get((None, "href"))
+                if url is not None:
+                    actual_url = parse_qs(urlparse(url).query).get("q")
+                    if actual_url is not None and len(actual_url) > 0:
+                        token["data"][(None, "href")] = actual_url[0]
+            yield (token)
+
+
+ReferenceCleaner = Cleaner(
+    tags=TAGS,
+    attributes=ATTRS,
+    styles=STYLES,
+    strip=True,
+    filters=[
+        KeepOnlyInterestingSpans,
+        ConvertPTagsToNewlines,
+        RemoveGoogleTrackingFromHrefs,
+    ],
+)
+
+EXPORTS_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "fixtures", "exports"
+)
+
+
+def best_time(clean, document: str, repeat: int) -> float:
+    return min(timeit.repeat(lambda: clean(document), number=1, repeat=repeat))
+
+
+def main(paths):
+    if not paths:
+        paths = [
+            os.path.join(EXPORTS_DIR, "%s.html" % size)
+            for size in ("small", "medium", "large")
+        ]
+    documents = []
+    for path in paths:
+        with open(path, encoding="utf-8-sig") as f:
+            documents.append((os.path.basename(path), f.read()))
+
+    print("%-30s %10s %12s %12s %8s" % ("document", "bytes", "previous", "current", ""))
+    for name, document in documents:
+        if GoogleDocHTMLCleaner.clean(document) != ReferenceCleaner.clean(document):
+            sys.exit("%s: the cleaners' output differs" % name)
+        repeat = 5 if len(document) > 100000 else 20
+        previous = best_time(ReferenceCleaner.clean, document, repeat)
+        current = best_time(GoogleDocHTMLCleaner.clean, document, repeat)
+        print(
+            "%-30s %10d %10.2fms %10.2fms %7.2fx"
+            % (name, len(document), previous * 1000, current * 1000, previous / current)
+        )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
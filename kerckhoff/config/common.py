@@ -8,6 +8,23 @@ from configurations import Configuration
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
+def get_caches(cache_host):
+    """Uses Redis as the cache when a host is configured
+
+    Otherwise falls back to Django's local memory cache, which is not shared between
+    processes: the web and celery workers each keep their own cache and sessions.
+    """
+    if not cache_host:
+        return {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+    return {
+        "default": {
+            "BACKEND": "django_redis.cache.RedisCache",
+            "LOCATION": cache_host,
+            "OPTIONS": {"CLIENT_CLASS": "django_redis.client.DefaultClient"},
+        }
+    }
+
+
 class Common(Configuration):
 
     INSTALLED_APPS = (
@@ -27,6 +44,7 @@ class Common(Configuration):
         "taggit",
         "taggit_serializer",
         "drf_yasg",
+        "django_celery_results",
         # Your apps
         "kerckhoff.users",
         "kerckhoff.userprofiles",
@@ -74,11 +92,17 @@ class Common(Configuration):
     SESSION_ENGINE = "django.contrib.sessions.backends.cache"
     SESSION_CACHE_ALIAS = "default"
     # Cache
-    CACHE = {
-        "default": {
-            "BACKEND": "django_redis.cache.RedisCache",
-            "LOCATION": os.getenv("CACHE_HOST"),
-            "OPTIONS": {"CLIENT_CLASS": "django_redis.client.DefaultClient"},
+    CACHES = get_caches(os.getenv("CACHE_HOST"))
+
+    # Celery
+    CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://redis:6379/0")
+    # Task results are stored with django-celery-results, so clients can poll them
+    CELERY_RESULT_BACKEND = "django-db"
+    # Package sets are kept in sync with the Google Drive changes feed by celery beat
+    CELERY_BEAT_SCHEDULE = {
+        "sync-gdrive-changes": {
+            "task": "kerckhoff.packages.tasks.sync_all_gdrive_changes_task",
+            "schedule": float(os.getenv("GDRIVE_CHANGES_SYNC_INTERVAL", 300)),
         }
     }
 
@@ -223,6 +247,16 @@ class Common(Configuration):
             "https://www.googleapis.com/auth/drive",
             "https://www.googleapis.com/auth/drive.file",
         ],
+        # Connections kept open to Google APIs for every user, per process
+        "HTTP_POOL_SIZE": int(os.getenv("GOOGLE_HTTP_POOL_SIZE", 16)),
+        # Rate limited and failed (5xx) GET requests are retried with backoff
+        "HTTP_MAX_RETRIES": int(os.getenv("GOOGLE_HTTP_MAX_RETRIES", 3)),
+        "HTTP_RETRY_BACKOFF_FACTOR": float(
+            os.getenv("GOOGLE_HTTP_RETRY_BACKOFF_FACTOR", 0.5)
+        ),
+        # Google Drive requests made for a user per second, across every worker
+        "DRIVE_RATE_LIMIT": float(os.getenv("GOOGLE_DRIVE_RATE_LIMIT", 10)),
+        "DRIVE_RATE_LIMIT_BURST": int(os.getenv("GOOGLE_DRIVE_RATE_LIMIT_BURST", 20)),
     }
 
     # Integrations
@@ -239,4 +273,36 @@ class Common(Configuration):
         "SECRET_KEY": os.getenv("AWS_SECRET_ACCESS_KEY"),
         "REGION": os.getenv("AWS_REGION"),
         "MEDIA_BUCKET_NAME": os.getenv("AWS_S3_MEDIA_BUCKET"),
+        # Optional, saves looking up the region of the media bucket
+        "MEDIA_BUCKET_REGION": os.getenv("AWS_S3_MEDIA_BUCKET_REGION"),
+    }
+
+    # Packages
+    PACKAGES = {
+        # Maximum number of Google Drive downloads performed in parallel for a package
+        "MAX_CONCURRENT_DOWNLOADS": int(
+            os.getenv("PACKAGES_MAX_CONCURRENT_DOWNLOADS", 8)
+        ),
+        # Maximum number of images snapshotted (downloaded, compressed and uploaded) at once
+        "MAX_CONCURRENT_SNAPSHOTS": int(
+            os.getenv("PACKAGES_MAX_CONCURRENT_SNAPSHOTS", 4)
+        ),
+        # Resized copies generated for every snapshotted image, name -> maximum width in px
+        "IMAGE_DERIVATIVES": {"large": 2048, "medium": 1024, "thumbnail": 400},
+        # JPEG and WebP quality of snapshotted images and their derivatives (1-100)
+        "IMAGE_QUALITY": int(os.getenv("PACKAGES_IMAGE_QUALITY", 95)),
+        # Also generate a WebP version of every derivative
+        "IMAGE_WEBP_DERIVATIVES": strtobool(
+            os.getenv("PACKAGES_IMAGE_WEBP_DERIVATIVES", "yes")
+        ),
+        # Markdown extensions used to render Markdown files, e.g. "extra,toc"
+        "MARKDOWN_EXTENSIONS": [
+            extension
+            for extension in os.getenv("PACKAGES_MARKDOWN_EXTENSIONS", "").split(",")
+            if extension
+        ],
+        # Seconds parsed file contents are cached for, keyed by the hash of their content
+        "PARSE_CACHE_TIMEOUT": int(
+            os.getenv("PACKAGES_PARSE_CACHE_TIMEOUT", 86400)
+        ),
     }
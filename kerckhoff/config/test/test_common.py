@@ -0,0 +1,19 @@
+from django.test import SimpleTestCase
+from nose.tools import eq_
+
+from ..common import get_caches
+
+
+class TestGetCaches(SimpleTestCase):
+
+    def test_redis_is_used_when_a_host_is_configured(self):
+        caches = get_caches('redis://redis:6379/1')
+        eq_(caches['default']['BACKEND'], 'django_redis.cache.RedisCache')
+        eq_(caches['default']['LOCATION'], 'redis://redis:6379/1')
+
+    def test_local_memory_is_used_without_a_host(self):
+        for cache_host in (None, ''):
+            eq_(
+                get_caches(cache_host),
+                {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+            )
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Package, PackageSet, PackageVersion, PackageItem
+from .models import Package, PackageSet, PackageSetTask, PackageVersion, PackageItem
 
 
 @admin.register(Package)
@@ -13,6 +13,11 @@ class PackageSetAdmin(admin.ModelAdmin):
     pass
 
 
+@admin.register(PackageSetTask)
+class PackageSetTaskAdmin(admin.ModelAdmin):
+    pass
+
+
 @admin.register(PackageVersion)
 class PackageVersionAdmin(admin.ModelAdmin):
     pass
@@ -0,0 +1,16 @@
+# Generated by Django 2.2 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("packages", "0003_package_state")]
+
+    operations = [
+        migrations.AddField(
+            model_name="packageitem",
+            name="content_hash",
+            field=models.CharField(blank=True, default="", max_length=64),
+        )
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2 on 2026-10-17 21:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("packages", "0004_packageitem_content_hash")]
+
+    operations = [
+        migrations.CreateModel(
+            name="PackageSetTask",
+            fields=[
+                (
+                    "task_id",
+                    models.CharField(max_length=255, primary_key=True, serialize=False),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "package_set",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="packages.PackageSet",
+                    ),
+                ),
+            ],
+        )
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2 on 2026-10-17 21:49
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("packages", "0005_packagesettask")]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="package",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["cached"], name="package_cached_gin", opclasses=["jsonb_path_ops"]
+            ),
+        )
+    ]
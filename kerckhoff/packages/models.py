@@ -1,26 +1,40 @@
 import re
 import uuid
-from typing import List, NamedTuple, Optional
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.indexes import GinIndex
 from django.core.validators import RegexValidator
 from django.db import models, transaction
 from django.utils.timezone import now
+from requests import Response
 from taggit.managers import TaggableManager
 
 from kerckhoff.packages.exceptions import GoogleDriveNotConfiguredException
+from kerckhoff.packages.operations.concurrency import map_concurrently
 from kerckhoff.packages.operations.google_drive import GoogleDriveOperations
 from kerckhoff.packages.operations.image_utils import ImageUtils
 from kerckhoff.packages.operations.models import (
     GoogleDriveFile,
     GoogleDriveImageFile,
     GoogleDriveTextFile,
-    FORMAT_MD,
+    DEFAULT_EXPORT_POLICIES,
+    EXPORT_PLAIN,
+    EXPORT_POLICIES,
+    EXPORT_RICH,
+    FIXED_EXPORT_POLICY_FORMATS,
 )
 from kerckhoff.packages.constants import *
-from kerckhoff.packages.operations.utils import GoogleDocHTMLCleaner
+from kerckhoff.packages.operations.parser import (
+    STREAM_CHUNK_SIZE as PARSE_STREAM_CHUNK_SIZE,
+)
+from kerckhoff.packages.operations.utils import (
+    GoogleDocHTMLCleaner,
+    decode_chunks,
+    html_to_text,
+)
 from kerckhoff.users.models import User as AppUser
 
 User: AppUser = get_user_model()
@@ -33,6 +47,12 @@ validate_slug_with_dots = RegexValidator(
 )
 
 GOOGLE_DRIVE_META_KEY = "google_drive"
+# Position in the Google Drive changes feed up to which a package set has been synced
+GOOGLE_DRIVE_CHANGES_TOKEN_KEY = "google_drive_changes_token"
+# Export policies of a package set which override the defaults, format -> policy
+EXPORT_POLICIES_KEY = "export_policies"
+# Number of changed Drive files looked up in the cached contents of packages at once
+CACHED_FILES_LOOKUP_BATCH_SIZE = 100
 
 
 class GoogleDriveMeta(NamedTuple):
@@ -59,6 +79,17 @@ class PackageSet(models.Model):
             self.save()
         return GoogleDriveMeta(**data)
 
+    def get_export_policies(self) -> Dict[str, str]:
+        """Returns the exports downloaded for each format of content file, see
+        DEFAULT_EXPORT_POLICIES"""
+        policies = dict(DEFAULT_EXPORT_POLICIES)
+        overrides = self.metadata.get(EXPORT_POLICIES_KEY) or {}
+        for file_format, policy in overrides.items():
+            fixed = file_format in FIXED_EXPORT_POLICY_FORMATS
+            if file_format in policies and not fixed and policy in EXPORT_POLICIES:
+                policies[file_format] = policy
+        return policies
+
     def get_new_packages_from_gdrive(self) -> List["Package"]:
         gdrive_info = self.get_or_create_gdrive_meta()
         if not gdrive_info.folder_id:
@@ -66,26 +97,147 @@ class PackageSet(models.Model):
 
         ops = GoogleDriveOperations(self.created_by)
 
-        items, _ = ops.list_folder(gdrive_info.folder_id)
-        folders = ops.filter_items(items, GoogleDriveOperations.FilterMethod.FOLDER)
-        created_packages = []
+        folders, _ = ops.list_folder(
+            gdrive_info.folder_id,
+            filters=[
+                GoogleDriveOperations.ItemFilter(
+                    GoogleDriveOperations.FilterMethod.FOLDER
+                )
+            ],
+        )
+
+        existing_slugs = set(
+            Package.objects.filter(package_set=self).values_list("slug", flat=True)
+        )
+        new_packages: List[Package] = []
         for folder in folders:
             slug = folder["title"]
-            package, created = Package.objects.get_or_create(
-                slug=slug,
-                package_set=self,
-                defaults={
-                    "created_by": self.created_by,
-                    "metadata": {
+            if slug in existing_slugs:
+                continue
+            # Folders with the same title map to the same package, the first one wins
+            existing_slugs.add(slug)
+            new_packages.append(
+                Package(
+                    slug=slug,
+                    package_set=self,
+                    created_by=self.created_by,
+                    metadata={
                         GOOGLE_DRIVE_META_KEY: GoogleDriveMeta(
                             folder_id=folder["id"], folder_url=folder["alternateLink"]
                         )._asdict()
                     },
-                },
+                )
+            )
+
+        if not new_packages:
+            return []
+
+        # Packages created concurrently by another sync are skipped, so only the rows that
+        # were actually inserted (identified by their generated ids) are returned
+        Package.objects.bulk_create(new_packages, ignore_conflicts=True)
+        return list(
+            Package.objects.filter(id__in=[package.id for package in new_packages])
+        )
+
+    def sync_gdrive_changes(self) -> Tuple[List["Package"], List["Package"]]:
+        """Applies the changes made on Google Drive since the package set was last synced
+
+        New package folders are imported, and the cached contents of packages with
+        changed files are refreshed. The first sync imports all new packages, and records
+        the position of the changes feed for the following syncs.
+
+        Returns:
+            Tuple[List[Package], List[Package]] -- the created and the refreshed packages
+        """
+        gdrive_info = self.get_or_create_gdrive_meta()
+        if not gdrive_info.folder_id:
+            raise GoogleDriveNotConfiguredException(self)
+
+        ops = GoogleDriveOperations(self.created_by)
+        page_token = self.metadata.get(GOOGLE_DRIVE_CHANGES_TOKEN_KEY)
+        if page_token:
+            changes, next_page_token = ops.list_changes(page_token)
+            created, refreshed = self._apply_gdrive_changes(gdrive_info, changes)
+        else:
+            # The token is taken before listing, so that changes made while the packages
+            # are imported are picked up by the next sync
+            next_page_token = ops.get_start_page_token()
+            created, refreshed = self.get_new_packages_from_gdrive(), []
+
+        self.metadata[GOOGLE_DRIVE_CHANGES_TOKEN_KEY] = next_page_token
+        self.save()
+        return created, refreshed
+
+    def _apply_gdrive_changes(
+        self, gdrive_info: GoogleDriveMeta, changes: List[dict]
+    ) -> Tuple[List["Package"], List["Package"]]:
+        # Only the folder ids are needed to match changes, so the cached contents of
+        # the whole set are not loaded
+        packages_by_folder = {}
+        for package_id, metadata in Package.objects.filter(
+            package_set=self
+        ).values_list("id", "metadata"):
+            folder_id = (metadata or {}).get(GOOGLE_DRIVE_META_KEY, {}).get("folder_id")
+            if folder_id:
+                packages_by_folder[folder_id] = package_id
+
+        new_folder_candidates = []
+        affected_ids = set()
+        for change in changes:
+            file = change.get("file") or {}
+            parent_ids = [parent["id"] for parent in file.get("parents", [])]
+            if gdrive_info.folder_id in parent_ids:
+                new_folder_candidates.append(file)
+            for parent_id in parent_ids:
+                if parent_id in packages_by_folder:
+                    affected_ids.add(packages_by_folder[parent_id])
+
+        # Files deleted or moved out of a package no longer list it as a parent, so the
+        # packages caching the changed files are looked up as well. Folders are never
+        # cached, and the lookups use the GIN index on the cached contents.
+        folders_mimetype = GoogleDriveOperations._GOOGLE_FOLDERS_MIMETYPE
+        changed_file_ids = sorted(
+            {
+                change["fileId"]
+                for change in changes
+                if (change.get("file") or {}).get("mimeType") != folders_mimetype
+            }
+        )
+        while changed_file_ids:
+            batch = changed_file_ids[:CACHED_FILES_LOOKUP_BATCH_SIZE]
+            changed_file_ids = changed_file_ids[CACHED_FILES_LOOKUP_BATCH_SIZE:]
+            cached_file_query = models.Q()
+            for file_id in batch:
+                cached_file_query |= models.Q(cached__contains=[{"drive_id": file_id}])
+            affected_ids.update(
+                Package.objects.filter(package_set=self)
+                .filter(cached_file_query)
+                .values_list("id", flat=True)
             )
-            if created:
-                created_packages.append(package)
-        return created_packages
+
+        created = []
+        if GoogleDriveOperations.filter_items(
+            new_folder_candidates, GoogleDriveOperations.FilterMethod.FOLDER
+        ):
+            created = self.get_new_packages_from_gdrive()
+
+        refreshed = list(Package.objects.filter(id__in=affected_ids))
+        for package in refreshed:
+            package.fetch_cache()
+        return created, refreshed
+
+
+class PackageSetTask(models.Model):
+    """
+    A background task started for a package set, e.g. an import from Google Drive
+    """
+
+    task_id = models.CharField(max_length=255, primary_key=True)
+    package_set = models.ForeignKey(PackageSet, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.package_set.slug + "/" + self.task_id
 
 
 class Package(models.Model):
@@ -126,6 +278,14 @@ class Package(models.Model):
 
     class Meta:
         unique_together = ("package_set", "slug")
+        indexes = [
+            # Finds the packages caching a Drive file, see PackageSet.sync_gdrive_changes
+            GinIndex(
+                fields=["cached"],
+                name="package_cached_gin",
+                opclasses=["jsonb_path_ops"],
+            )
+        ]
 
     def get_version(self, number: int):
         try:
@@ -146,9 +306,26 @@ class Package(models.Model):
             self.save()
         return GoogleDriveMeta(**data)
 
-    def fetch_cache(self):
+    def fetch_cache(self, incremental: bool = True):
+        """Refreshes the cached contents of the package from Google Drive
+
+        Keyword Arguments:
+            incremental {bool} -- only download and parse the content files that were
+                modified since they were last cached (default: {True})
+        """
         ops = GoogleDriveOperations(self.created_by)
-        items, _ = ops.list_folder(self.get_or_create_gdrive_meta().folder_id)
+        content_extensions = ("aml", "md", "txt")
+        items, _ = ops.list_folder(
+            self.get_or_create_gdrive_meta().folder_id,
+            filters=[
+                GoogleDriveOperations.ItemFilter(
+                    GoogleDriveOperations.FilterMethod.IMAGES
+                ),
+                GoogleDriveOperations.ItemFilter(
+                    GoogleDriveOperations.FilterMethod.EXTENSION, content_extensions
+                ),
+            ],
+        )
 
         # Images / Media
         images_raw = ops.filter_items(items, GoogleDriveOperations.FilterMethod.IMAGES)
@@ -156,27 +333,65 @@ class Package(models.Model):
 
         # Content / Data Files
         content_files_raw = ops.filter_items(
-            items, GoogleDriveOperations.FilterMethod.EXTENSION, ("aml", "md", "txt")
+            items, GoogleDriveOperations.FilterMethod.EXTENSION, content_extensions
         )
         content_files: List[GoogleDriveTextFile] = [
             GoogleDriveTextFile(content_file) for content_file in content_files_raw
         ]
 
-        # Export content files as HTML and plaintext
-        for file in content_files:
-            if file.format != FORMAT_MD:
-                # Markdown does not support HTML format, so we do not do is_rich for MD
-                file._is_rich = True
-                file.parse_content(
-                    GoogleDocHTMLCleaner.clean(ops.download_item(file).text),
-                    is_rich=True,
-                )
-
-            file._is_rich = False
-            file.parse_content(
-                ops.download_item(file).content.decode("utf-8-sig").encode("utf-8"),
-                is_rich=False,
-            )
+        # Reuse the parsed content of files which have not changed since the last fetch
+        previously_cached = {}
+        if incremental and self.cached:
+            previously_cached = {
+                ci["drive_id"]: ci
+                for ci in self.cached
+                if ci.get("_code") == GoogleDriveTextFile._code
+            }
+
+        export_policies = self.package_set.get_export_policies()
+        changed_files: List[GoogleDriveTextFile] = []
+        for index, file in enumerate(content_files):
+            cached_item = previously_cached.get(file.drive_id)
+            unchanged = cached_item is not None and file.is_unchanged_since(cached_item)
+            # Files cached before their HTML export was needed are downloaded again
+            if unchanged and export_policies[file.format] != EXPORT_PLAIN:
+                unchanged = cached_item.get("content_rich") is not None
+            if unchanged:
+                content_files[index] = GoogleDriveTextFile.from_json(cached_item)
+            else:
+                changed_files.append(file)
+
+        # Export content files as HTML and/or plaintext according to the package set's
+        # export policies, all exports are downloaded in parallel
+        downloads = []
+        for file in changed_files:
+            policy = export_policies[file.format]
+            if policy != EXPORT_PLAIN:
+                downloads.append((file, {"is_rich": True}))
+            if policy != EXPORT_RICH:
+                downloads.append((file, {"is_rich": False}))
+
+        def stream_plain(
+            file: GoogleDriveTextFile, kwargs: dict, response: Response
+        ) -> Optional[Response]:
+            if kwargs["is_rich"]:
+                response.content
+                return response
+            # Plain exports are parsed by the download threads, ArchieML while it is
+            # downloaded. HTML is cleaned below as the cleaner is not thread safe.
+            chunks = response.iter_content(PARSE_STREAM_CHUNK_SIZE)
+            file.parse_stream(decode_chunks(chunks), is_rich=False)
+            return None
+
+        responses = ops.download_items(downloads, consume=stream_plain)
+
+        for (file, kwargs), response in zip(downloads, responses):
+            if response is None:
+                continue
+            cleaned_html = GoogleDocHTMLCleaner.clean(response.text)
+            file.parse_content(cleaned_html, is_rich=True)
+            if export_policies[file.format] == EXPORT_RICH:
+                file.parse_content(html_to_text(cleaned_html), is_rich=False)
 
         to_update: List[GoogleDriveFile] = images + content_files
 
@@ -200,40 +415,95 @@ class Package(models.Model):
             package_version {PackageVersion} -- the package version to be added
             updated_package_item_titles {List[str]} -- list of item titles to be included
         """
-        with transaction.atomic():
-            package_version.id_num = self.packageversion_set.count() + 1
-            updated_package_item_titles_set = set(updated_package_item_titles)
+        updated_package_item_titles_set = set(updated_package_item_titles)
+
+        package_version.created_by = user
+        package_version.package = self
+        package_version.full_clean()
+
+        # Items from the last version, as (id, file name, content hash). Several items
+        # may have the same file name, as Google Drive allows files with the same title.
+        previous_items: List[Tuple[uuid.UUID, str, str]] = []
+        if self.latest_version_id:
+            previous_items = list(
+                PackageItem.objects.filter(
+                    package_versions=self.latest_version_id
+                ).values_list("id", "file_name", "content_hash")
+            )
+        reusable_item_ids: Dict[Tuple[str, str], List[uuid.UUID]] = {}
+        for item_id, file_name, content_hash in previous_items:
+            if content_hash:
+                reusable_item_ids.setdefault((file_name, content_hash), []).append(
+                    item_id
+                )
 
-            package_version.created_by = user
-            package_version.package = self
+        # Updated items whose content is identical to an item of the last version with
+        # the same file name are linked again instead of being snapshotted
+        reused_item_ids = []
+        files_to_snapshot: List[Tuple[GoogleDriveFile, Optional[str]]] = []
+        for ci in self.cached:
+            if ci["title"] not in updated_package_item_titles_set:
+                continue
+            google_drive_file = GoogleDriveFile.from_json(ci)
+            content_hash = google_drive_file.get_content_hash()
+            matching_item_ids = reusable_item_ids.get(
+                (google_drive_file.title, content_hash)
+            )
+            if content_hash and matching_item_ids:
+                reused_item_ids.append(matching_item_ids.pop())
+            else:
+                files_to_snapshot.append((google_drive_file, content_hash))
+
+        # Snapshotting downloads, compresses and uploads images, so it is done in parallel
+        # before the transaction is opened. If a snapshot fails, the snapshots that have
+        # not started are cancelled, but images already uploaded are left in S3. Those
+        # with a checksum are content addressed, and are reused by the next attempt.
+        if any(isinstance(f, GoogleDriveImageFile) for f, _ in files_to_snapshot):
+            image_utils = ImageUtils(user, GoogleDriveOperations(user))
+        else:
+            image_utils = ImageUtils(user)
+        snapshots = map_concurrently(
+            lambda file_to_snapshot: file_to_snapshot[0].snapshot(
+                image_utils=image_utils
+            ),
+            files_to_snapshot,
+            settings.PACKAGES["MAX_CONCURRENT_SNAPSHOTS"],
+        )
 
-            package_version.full_clean()
+        with transaction.atomic():
+            package_version.id_num = self.packageversion_set.count() + 1
             package_version.save()
 
-            # Items from the last version
-            previous_version: Optional[PackageVersion] = self.latest_version
-            if previous_version:
-                previous_items = list(previous_version.packageitem_set.all())
-            else:
-                previous_items: List[PackageItem] = []
-
             # All previous items that are not updated
-            not_updated_items = [
-                pi
-                for pi in previous_items
-                if pi.file_name not in updated_package_item_titles_set
+            not_updated_item_ids = [
+                item_id
+                for item_id, file_name, _ in previous_items
+                if file_name not in updated_package_item_titles_set
             ]
 
             # All the updated items
-            updated_items = [
-                PackageItem.create_from_google_drive_item(
-                    user, GoogleDriveFile.from_json(ci)
-                )
-                for ci in self.cached
-                if ci["title"] in updated_package_item_titles_set
-            ]
+            updated_items = PackageItem.objects.bulk_create(
+                [
+                    PackageItem.from_snapshot(google_drive_file, snapshot, content_hash)
+                    for (google_drive_file, content_hash), snapshot in zip(
+                        files_to_snapshot, snapshots
+                    )
+                ]
+            )
 
-            package_version.packageitem_set.add(*(updated_items + not_updated_items))
+            # Link all items to the new version with a single insert
+            item_ids = (
+                [pi.id for pi in updated_items] + reused_item_ids + not_updated_item_ids
+            )
+            PackageItemVersions = PackageItem.package_versions.through
+            PackageItemVersions.objects.bulk_create(
+                [
+                    PackageItemVersions(
+                        packageitem_id=item_id, packageversion_id=package_version.id
+                    )
+                    for item_id in item_ids
+                ]
+            )
 
             self.latest_version = package_version
             self.save()
@@ -279,6 +549,8 @@ class PackageItem(models.Model):
     data = JSONField(blank=True, default=dict)
     file_name = models.CharField(max_length=64)
     mime_type = models.CharField(max_length=64)
+    # Identifies the snapshotted content, see GoogleDriveFile.get_content_hash
+    content_hash = models.CharField(max_length=64, blank=True, default="")
     tags = TaggableManager()
 
     def refresh(self):
@@ -293,11 +565,45 @@ class PackageItem(models.Model):
     def create_from_google_drive_item(
         cls, user: User, google_drive_file: GoogleDriveFile
     ) -> "PackageItem":
-        pi = cls(
+        return cls.create_from_snapshot(
+            google_drive_file,
+            google_drive_file.snapshot(image_utils=ImageUtils(user)),
+        )
+
+    @classmethod
+    def create_from_snapshot(
+        cls, google_drive_file: GoogleDriveFile, snapshot: dict
+    ) -> "PackageItem":
+        """Creates a PackageItem from a file that has already been snapshotted
+
+        Arguments:
+            google_drive_file {GoogleDriveFile} -- the snapshotted file
+            snapshot {dict} -- the result of `google_drive_file.snapshot`
+        """
+        pi = cls.from_snapshot(google_drive_file, snapshot)
+        pi.save()
+        return pi
+
+    @classmethod
+    def from_snapshot(
+        cls,
+        google_drive_file: GoogleDriveFile,
+        snapshot: dict,
+        content_hash: Optional[str] = None,
+    ) -> "PackageItem":
+        """Builds an unsaved PackageItem from a file that has already been snapshotted,
+        suitable for `bulk_create`
+
+        Keyword Arguments:
+            content_hash {Optional[str]} -- the precomputed content hash of the file
+                (default: computed from `google_drive_file`)
+        """
+        if content_hash is None:
+            content_hash = google_drive_file.get_content_hash()
+        return cls(
             data_type=google_drive_file.get_data_type(),
-            data=google_drive_file.snapshot(image_utils=ImageUtils(user)),
+            data=snapshot,
             file_name=google_drive_file.title,
             mime_type=google_drive_file.mimeType,
+            content_hash=content_hash or "",
         )
-        pi.save()
-        return pi
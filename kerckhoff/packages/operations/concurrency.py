@@ -0,0 +1,46 @@
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from typing import Callable, Iterable, List, TypeVar
+
+from django.db import connection
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def map_concurrently(
+    fn: Callable[[T], R], items: Iterable[T], max_workers: int
+) -> List[R]:
+    """Applies `fn` to every item using a bounded thread pool
+
+    Results are returned in the same order as `items`. The first exception raised by
+    `fn` is propagated to the caller, once the calls already running have finished.
+    Calls that have not started yet are cancelled.
+
+    Arguments:
+        fn {Callable} -- the function to apply, must be thread safe
+        items {Iterable} -- the items to process
+        max_workers {int} -- the maximum number of threads used at once
+
+    Returns:
+        List -- the results of `fn` for every item
+    """
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+
+    def _run(item):
+        try:
+            return fn(item)
+        finally:
+            # Worker threads get their own database connection if they touch the ORM
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        futures = [executor.submit(_run, item) for item in items]
+        done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in not_done:
+            future.cancel()
+        for future in futures:
+            if future in done and future.exception() is not None:
+                raise future.exception()
+        return [future.result() for future in futures]
@@ -4,6 +4,8 @@ class OperationFailed(APIException):
     status_code = 500
     default_detail = "An operation has failed."
 
-    def __init__(self, responseDict: dict):
-        if cause:
-            self.detail = f"An operation has failed, Cause: {str(responseDict)}"
+    def __init__(self, responseDict: dict = None):
+        detail = None
+        if responseDict:
+            detail = f"An operation has failed, Cause: {str(responseDict)}"
+        super().__init__(detail)
@@ -1,13 +1,37 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from requests_oauthlib import OAuth2Session
 from requests.exceptions import RequestException
 from requests import Response
-from typing import Tuple, Optional, List
+from typing import (
+    Callable,
+    Dict,
+    Tuple,
+    Optional,
+    List,
+    NamedTuple,
+    Sequence,
+    TypeVar,
+    Union,
+)
+from email import message_from_bytes
+from email.utils import parsedate_to_datetime
 from enum import Enum
+from urllib.parse import quote, urlencode
+import json
 import logging
+import random
+import re
+import time
+import uuid
 
+from kerckhoff.packages.operations.concurrency import map_concurrently
 from kerckhoff.packages.operations.exceptions import OperationFailed
 from kerckhoff.packages.operations.models import GoogleDriveTextFile, GoogleDriveFile
+from kerckhoff.packages.operations.rate_limiter import (
+    get_user_rate_limiter,
+    record_quota_usage,
+)
 from kerckhoff.users.auth.google import GoogleOAuthStrategy
 
 from kerckhoff.users.models import User as AppUser
@@ -16,13 +40,37 @@ logger = logging.getLogger(__name__)
 
 User: AppUser = get_user_model()
 
+T = TypeVar("T")
+
 
 class GoogleDriveOperations:
     oauth_session: OAuth2Session
 
     _GOOGLE_API_PREFIX = "https://www.googleapis.com/drive"
+    _GOOGLE_BATCH_URL = "https://www.googleapis.com/batch/drive/v2"
     _GOOGLE_DOCS_MIMETYPE = "application/vnd.google-apps.document"
     _GOOGLE_FOLDERS_MIMETYPE = "application/vnd.google-apps.folder"
+    _MAX_PAGE_SIZE = 1000
+    _MAX_BATCH_SIZE = 100
+    # Reasons given by Drive for 403 responses when a rate limit is exceeded
+    _RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+    # The fields of a file read by GoogleDriveFile and its subclasses
+    FILE_FIELDS = ",".join(
+        (
+            "id",
+            "title",
+            "mimeType",
+            "selfLink",
+            "alternateLink",
+            "thumbnailLink",
+            "modifiedDate",
+            "md5Checksum",
+            "lastModifyingUser/displayName",
+        )
+    )
+    # The fields of a change read when syncing package sets
+    CHANGE_FIELDS = "fileId,deleted,file(id,mimeType,parents/id)"
 
     class FilterMethod(Enum):
         EXTENSION = 1
@@ -30,8 +78,13 @@ class GoogleDriveOperations:
         FOLDER = 3
         IMAGES = 4
 
+    class ItemFilter(NamedTuple):
+        type: "GoogleDriveOperations.FilterMethod"
+        extensions: Tuple[str, ...] = ("",)
+
     def __init__(self, user: User):
-        self.oauth_session = GoogleOAuthStrategy.create_oauth2_session(user)
+        self.oauth_session = GoogleOAuthStrategy.get_oauth2_session(user)
+        self.rate_limiter = get_user_rate_limiter(user.pk)
 
     @classmethod
     def filter_items(
@@ -46,42 +99,65 @@ class GoogleDriveOperations:
         elif type == cls.FilterMethod.IMAGES:
             return [i for i in items if i["mimeType"].startswith("image/")]
 
+    @classmethod
+    def _get_filter_query(cls, item_filter: ItemFilter) -> str:
+        """Returns the Drive query matching (at least) the items selected by a filter"""
+        if item_filter.type == cls.FilterMethod.DOCUMENT:
+            return f"mimeType = '{cls._GOOGLE_DOCS_MIMETYPE}'"
+        elif item_filter.type == cls.FilterMethod.EXTENSION:
+            # Drive can only match the start of words in titles, so extensions are
+            # checked client side and only folders are excluded here
+            return f"mimeType != '{cls._GOOGLE_FOLDERS_MIMETYPE}'"
+        elif item_filter.type == cls.FilterMethod.FOLDER:
+            return f"mimeType = '{cls._GOOGLE_FOLDERS_MIMETYPE}'"
+        elif item_filter.type == cls.FilterMethod.IMAGES:
+            return "mimeType contains 'image/'"
+
     def list_folder(
-        self, gdrive_folder_id: str, all: bool = True, page_token: str = None
+        self,
+        gdrive_folder_id: str,
+        all: bool = True,
+        page_token: str = None,
+        fields: Optional[str] = FILE_FIELDS,
+        filters: Sequence[ItemFilter] = (),
     ) -> Tuple[list, str]:
         """List the items in a Google Drive Folder, specified by the folder id.
 
+        Only the `fields` of each item are requested, None requests the full resources.
+        If `filters` are given, only the items matching any of them are listed. The
+        filters are applied by Drive where possible, and client side otherwise.
+
         Returns the list of items, and the page token for the next page
         """
 
-        payload = {
-            "q": f"'{gdrive_folder_id}' in parents and trashed=false",
-            "orderBy": "title",
-            "maxResults": 100,
-        }
+        query = f"'{gdrive_folder_id}' in parents and trashed=false"
+        if filters:
+            filter_queries = " or ".join(self._get_filter_query(f) for f in filters)
+            query += f" and ({filter_queries})"
+
+        payload = {"q": query, "orderBy": "title", "maxResults": self._MAX_PAGE_SIZE}
+
+        if fields:
+            payload["fields"] = f"nextPageToken,items({fields})"
 
         if page_token:
             payload["pageToken"] = page_token
 
         results = []
-        next_url: str = None
         next_token: str = None
 
         while True:
             try:
-                if not next_url:
-                    response = self.oauth_session.get(
-                        self._GOOGLE_API_PREFIX + "/v2/files", params=payload
-                    )
-                else:
-                    response = self.oauth_session.get(next_url)
+                response = self._request(
+                    "GET", self._GOOGLE_API_PREFIX + "/v2/files", params=payload
+                )
                 response.raise_for_status()
                 res_json = response.json()
 
                 results += res_json["items"]
                 next_token = res_json.get("nextPageToken")
                 if all and next_token:
-                    next_url = res_json["nextLink"]
+                    payload["pageToken"] = next_token
                 else:
                     break
 
@@ -91,18 +167,196 @@ class GoogleDriveOperations:
                 )
                 raise OperationFailed(response.json())
 
+        if filters:
+            matching_ids = {
+                item["id"]
+                for f in filters
+                for item in self.filter_items(results, f.type, f.extensions)
+            }
+            results = [item for item in results if item["id"] in matching_ids]
+
         return results, next_token
 
-    def download_item(self, gdrive_item: GoogleDriveFile) -> Response:
-        """Downloads the contents of the provided Google Drive file, returns a Requests response"""
+    def get_start_page_token(self) -> str:
+        """Returns the page token of the current position of the Drive changes feed
+
+        Changes made after this call are returned by `list_changes` with this token.
+        """
+        response = self._request(
+            "GET", self._GOOGLE_API_PREFIX + "/v2/changes/startPageToken"
+        )
+        if not response.ok:
+            logger.error(
+                f"Failed to get the changes start page token {response.json()}"
+            )
+            raise OperationFailed(response.json())
+        return response.json()["startPageToken"]
+
+    def list_changes(self, page_token: str) -> Tuple[list, str]:
+        """Lists the changes to the user's Drive since the provided page token.
+
+        Returns the list of changes, and the page token to use for the next call
+        """
+        payload = {
+            "pageToken": page_token,
+            "includeDeleted": "true",
+            "includeSubscribed": "true",
+            "maxResults": self._MAX_PAGE_SIZE,
+            "fields": f"nextPageToken,newStartPageToken,items({self.CHANGE_FIELDS})",
+        }
+
+        results = []
+        while True:
+            try:
+                response = self._request(
+                    "GET", self._GOOGLE_API_PREFIX + "/v2/changes", params=payload
+                )
+                response.raise_for_status()
+                res_json = response.json()
+            except RequestException:
+                logger.error(
+                    f"Failed to list changes from token:{payload['pageToken']} {response.json()}"
+                )
+                raise OperationFailed(response.json())
+
+            results += res_json.get("items", [])
+            if res_json.get("nextPageToken"):
+                payload["pageToken"] = res_json["nextPageToken"]
+            else:
+                return results, res_json["newStartPageToken"]
+
+    def download_item(self, gdrive_item: GoogleDriveFile, **kwargs) -> Response:
+        """Downloads the contents of the provided Google Drive file, returns a Requests response
+
+        Any keyword arguments are passed on to `get_download_link` of the file.
+        """
         logger.debug(f"Downloading {gdrive_item.title}")
-        res = self.oauth_session.get(gdrive_item.get_download_link(), stream=True)
+        res = self._request("GET", gdrive_item.get_download_link(**kwargs), stream=True)
         return res
 
-    def _fetch_item_metadata(self, gdrive_id: str) -> Optional[dict]:
-        """Calls the API to get a single item
+    def download_items(
+        self,
+        downloads: List[Tuple[GoogleDriveFile, dict]],
+        max_workers: int = None,
+        consume: Callable[[GoogleDriveFile, dict, Response], T] = None,
+    ) -> List[Union[Response, T]]:
+        """Downloads the contents of many Google Drive files in parallel
+
+        Arguments:
+            downloads {List[Tuple[GoogleDriveFile, dict]]} -- the files to download, each
+                paired with the keyword arguments for `download_item`
+
+        Keyword Arguments:
+            max_workers {int} -- the maximum number of concurrent downloads
+                (default: settings.PACKAGES["MAX_CONCURRENT_DOWNLOADS"])
+            consume {Callable} -- called on the downloading thread with each file, its
+                keyword arguments and its streamed response, e.g. to process the content
+                while it is downloaded (default: read the whole response)
+
+        Returns:
+            List -- the fully read responses, or the results of `consume`, in the same
+                order as `downloads`
         """
-        res = self.oauth_session.get(self._GOOGLE_API_PREFIX + f"/v2/files/{gdrive_id}")
+        if max_workers is None:
+            max_workers = settings.PACKAGES["MAX_CONCURRENT_DOWNLOADS"]
+
+        def _download(download: Tuple[GoogleDriveFile, dict]):
+            gdrive_item, kwargs = download
+            res = self.download_item(gdrive_item, **kwargs)
+            if consume is not None:
+                with res:
+                    return consume(gdrive_item, kwargs, res)
+            # Read the body on the worker thread, as the response is streamed
+            res.content
+            return res
+
+        return map_concurrently(_download, downloads, max_workers)
+
+    def _request(self, method: str, url: str, cost: int = 1, **kwargs) -> Response:
+        """Sends a request to the Drive API within the rate limit of the user
+
+        Requests rejected by the rate limits of Google are retried with exponential
+        backoff, waiting at least as long as asked by their Retry-After header. The rate
+        limit is paused meanwhile, which slows down every worker for the same user.
+
+        The `cost` is the number of requests charged by Drive, e.g. the parts of a batch.
+        """
+        max_retries = settings.GOOGLE_OAUTH["HTTP_MAX_RETRIES"]
+        for attempt in range(max_retries + 1):
+            waited = self.rate_limiter.acquire(cost)
+            response = self.oauth_session.request(method, url, **kwargs)
+            throttled = self._is_rate_limited(response)
+            record_quota_usage(waited, throttled, cost)
+            if not throttled or attempt == max_retries:
+                return response
+
+            retry_after = self._get_retry_after(response)
+            response.close()
+            self._wait_before_retry(attempt, retry_after, response.status_code)
+
+    def _wait_before_retry(
+        self, attempt: int, retry_after: Optional[float], status_code: int
+    ):
+        """Waits before retrying a rate limited request, pausing the rate limit"""
+        backoff_factor = settings.GOOGLE_OAUTH["HTTP_RETRY_BACKOFF_FACTOR"]
+        delay = max(
+            retry_after or 0,
+            backoff_factor * (2 ** attempt) + random.uniform(0, backoff_factor),
+        )
+        logger.warning(
+            f"Rate limited by Google Drive, retrying in {delay:.1f}s. "
+            f"Code:{status_code}"
+        )
+        self.rate_limiter.pause(delay)
+        time.sleep(delay)
+
+    @classmethod
+    def _is_rate_limited(cls, response: Response) -> bool:
+        if response.status_code not in (403, 429):
+            return False
+        try:
+            content = response.json()
+        except ValueError:
+            content = None
+        return cls._is_rate_limit_error(response.status_code, content)
+
+    @classmethod
+    def _is_rate_limit_error(cls, status_code: int, content) -> bool:
+        """Checks if a status code and JSON error body reject a request for its rate"""
+        if status_code == 429:
+            return True
+        if status_code != 403:
+            return False
+        try:
+            errors = content["error"]["errors"]
+        except (KeyError, TypeError):
+            return False
+        return any(error.get("reason") in cls._RATE_LIMIT_REASONS for error in errors)
+
+    @staticmethod
+    def _get_retry_after(response: Response) -> Optional[float]:
+        """Returns the number of seconds to wait asked by the Retry-After header"""
+        retry_after = response.headers.get("Retry-After")
+        if not retry_after:
+            return None
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+        try:
+            return parsedate_to_datetime(retry_after).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+
+    def _fetch_item_metadata(
+        self, gdrive_id: str, fields: Optional[str] = FILE_FIELDS
+    ) -> Optional[dict]:
+        """Calls the API to get a single item, with only the requested fields
+        """
+        params = {"fields": fields} if fields else None
+        res = self._request(
+            "GET", self._GOOGLE_API_PREFIX + f"/v2/files/{gdrive_id}", params=params
+        )
         if res.ok:
             return res.json()
         else:
@@ -110,3 +364,118 @@ class GoogleDriveOperations:
                 f"Failed to fetch item from GDrive. Code:{res.status_code} Response:{res.json()}"
             )
             return None
+
+    def fetch_items_metadata(
+        self, gdrive_ids: Sequence[str], fields: Optional[str] = FILE_FIELDS
+    ) -> Dict[str, Optional[dict]]:
+        """Gets many items at once, with only the requested fields
+
+        Up to 100 items are fetched by every call, through the batch endpoint of Drive.
+
+        Returns a dict of id -> item, the item is None if it could not be fetched
+        """
+        results = {}
+        for start in range(0, len(gdrive_ids), self._MAX_BATCH_SIZE):
+            end = start + self._MAX_BATCH_SIZE
+            batch = gdrive_ids[start:end]
+            results.update(self._fetch_items_metadata_batch(batch, fields))
+        return results
+
+    def _fetch_items_metadata_batch(
+        self, gdrive_ids: Sequence[str], fields: Optional[str]
+    ) -> Dict[str, Optional[dict]]:
+        """Fetches the items of a batch, retrying the parts rejected by rate limits
+
+        Drive charges every part of a batch as a request, and may rate limit some of
+        them while the batch itself succeeds.
+        """
+        results = {gdrive_id: None for gdrive_id in gdrive_ids}
+        max_retries = settings.GOOGLE_OAUTH["HTTP_MAX_RETRIES"]
+        pending = list(gdrive_ids)
+        for attempt in range(max_retries + 1):
+            throttled = []
+            for gdrive_id, status_code, item in self._send_metadata_batch(
+                pending, fields
+            ):
+                if status_code == 200:
+                    results[gdrive_id] = item
+                elif self._is_rate_limit_error(status_code, item):
+                    throttled.append(gdrive_id)
+                else:
+                    logger.error(
+                        f"Failed to fetch item {gdrive_id} from GDrive. "
+                        f"Code:{status_code} Response:{item}"
+                    )
+            record_quota_usage(0, len(throttled), requests=0)
+            if not throttled:
+                break
+            if attempt == max_retries:
+                logger.error(
+                    f"Failed to fetch {len(throttled)} items from GDrive, rate limited"
+                )
+                break
+            self._wait_before_retry(attempt, None, 429)
+            pending = throttled
+        return results
+
+    def _send_metadata_batch(
+        self, gdrive_ids: Sequence[str], fields: Optional[str]
+    ) -> List[Tuple[str, int, dict]]:
+        """Sends a batch request for the items
+
+        Returns the id, the status code and the JSON body of each item
+        """
+        boundary = f"batch_{uuid.uuid4().hex}"
+        query = f"?{urlencode({'fields': fields})}" if fields else ""
+        body = "".join(
+            f"--{boundary}\r\n"
+            "Content-Type: application/http\r\n"
+            f"Content-ID: <item-{index}>\r\n\r\n"
+            f"GET /drive/v2/files/{quote(gdrive_id, safe='')}{query}\r\n\r\n"
+            for index, gdrive_id in enumerate(gdrive_ids)
+        )
+        body += f"--{boundary}--\r\n"
+
+        response = self._request(
+            "POST",
+            self._GOOGLE_BATCH_URL,
+            cost=len(gdrive_ids),
+            data=body.encode("utf-8"),
+            headers={"Content-Type": f"multipart/mixed; boundary={boundary}"},
+        )
+        if not response.ok:
+            logger.error(
+                f"Failed to fetch items from GDrive. Code:{response.status_code}"
+            )
+            raise OperationFailed(response.json())
+
+        return [
+            (gdrive_ids[index], status_code, item)
+            for index, status_code, item in self._parse_batch_response(response)
+        ]
+
+    @staticmethod
+    def _parse_batch_response(response: Response) -> List[Tuple[int, int, dict]]:
+        """Splits the response of the batch endpoint into its parts
+
+        Returns the index of the request, the status code and the JSON body of each part
+        """
+        content_type = response.headers["Content-Type"].encode("utf-8")
+        message = message_from_bytes(
+            b"Content-Type: " + content_type + b"\r\n\r\n" + response.content
+        )
+
+        parts = []
+        for part in message.get_payload():
+            index = int(re.search(r"item-(\d+)", part["Content-ID"]).group(1))
+            # Each part is an HTTP response: the status line, headers and the body. The
+            # payload is taken as bytes, as its UTF-8 body would be escaped as a str.
+            http_response = part.get_payload(decode=True).decode("utf-8")
+            status_line = http_response.lstrip().split("\n", 1)[0]
+            body = re.split(r"\r?\n\r?\n", http_response.strip(), 1)[-1]
+            try:
+                content = json.loads(body)
+            except ValueError:
+                content = {"error": body}
+            parts.append((index, int(status_line.split()[1]), content))
+        return parts
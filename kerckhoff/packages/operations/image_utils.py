@@ -1,7 +1,10 @@
+import io
+import json
 import logging
-import os
 import tempfile
 import mimetypes
+import uuid
+from typing import TYPE_CHECKING
 
 from PIL import Image
 from django.conf import settings
@@ -10,71 +13,213 @@ from django.contrib.auth import get_user_model
 from kerckhoff.packages.operations.google_drive import GoogleDriveOperations
 from kerckhoff.packages.operations.s3_utils import (
     get_s3_client,
-    upload_file,
+    upload_fileobj,
     get_bucket_region,
+    get_object_metadata,
 )
 from kerckhoff.users.models import User as AppUser
 
+if TYPE_CHECKING:
+    from kerckhoff.packages.operations.models import GoogleDriveImageFile
+
 logger = logging.getLogger(__name__)
 
 User: AppUser = get_user_model()
 
+# Images larger than this are spooled to disk while being processed
+SPOOL_MAX_SIZE = 32 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class SpooledBuffer(tempfile.SpooledTemporaryFile):
+    """A spooled temporary file which stays in memory until it outgrows its max size
+
+    PIL asks for the file descriptor of the files it saves JPEG and PNG images to, which
+    makes a SpooledTemporaryFile roll over to disk right away. This buffer only has a file
+    descriptor once it has rolled over, so the encoders write to it in memory.
+    """
+
+    def fileno(self):
+        if not self._rolled:
+            raise io.UnsupportedOperation("fileno")
+        return super().fileno()
+
 
 class ImageUtils:
-    def __init__(self, user: User):
+    def __init__(self, user: User, drive_ops: GoogleDriveOperations = None):
+        """
+        Arguments:
+            user {User} -- the user whose Google Drive credentials are used
+
+        Keyword Arguments:
+            drive_ops {GoogleDriveOperations} -- an existing Google Drive client for the user,
+                shared by every image snapshotted with this instance (default: {None})
+        """
         self._user = user
+        self._drive_ops = drive_ops
+
+    def _get_drive_ops(self) -> GoogleDriveOperations:
+        if self._drive_ops is None:
+            self._drive_ops = GoogleDriveOperations(self._user)
+        return self._drive_ops
 
     def snapshot_image(
         self,
         google_drive_image_file: "GoogleDriveImageFile",
         bucket=settings.AWS_CONFIG["MEDIA_BUCKET_NAME"],
-        quality=95,
+        quality=None,
     ):
         """Download images from package, compresses them and uploads them into s3
 
+        Resized derivatives of the image, configured by settings.PACKAGES["IMAGE_DERIVATIVES"],
+        are generated from the same decoded image and uploaded alongside it.
+
         Keyword arguments:
         google_drive_image_file {GoogleDriveImageFile} -- drive image
         bucket {str} - bucket to upload the image to
-        quality {int} -- quality to compress image to (1-100, default:95)
+        quality {int} -- quality to compress image to
+            (1-100, default: settings.PACKAGES["IMAGE_QUALITY"])
         """
+        if quality is None:
+            quality = settings.PACKAGES["IMAGE_QUALITY"]
         s3 = get_s3_client()
-        op = GoogleDriveOperations(self._user)
-        res = op.download_item(google_drive_image_file)
-        if res.ok:
-            # ToDo: Handle non-jpeg
-            ext = mimetypes.guess_extension(google_drive_image_file.mimeType)
-            with tempfile.NamedTemporaryFile(suffix=ext, delete=False) as f:
-                image_path = f.name
-                for chunk in res:
-                    f.write(chunk)
-                f.flush()
-                self._compress_image(
-                    image_path,
-                    quality=quality,
-                    mimetype=google_drive_image_file.mimeType,
-                )
-                key, s3_res = upload_file(
-                    s3, image_path, bucket, google_drive_image_file.mimeType
-                )
-                logger.info(f"Uploaded to S3 with result {s3_res}")
-                return {
-                    "key": key,
-                    "bucket": bucket,
-                    "region": get_bucket_region(s3, bucket),
-                    "meta": s3_res,
-                }
+        mimetype = google_drive_image_file.mimeType
+        ext = mimetypes.guess_extension(mimetype)
+        derivative_widths: dict = settings.PACKAGES["IMAGE_DERIVATIVES"]
+        with_webp: bool = settings.PACKAGES["IMAGE_WEBP_DERIVATIVES"]
+
+        # Images with a known checksum are stored under a content addressed key, so an
+        # image that was already snapshotted is not downloaded or uploaded again
+        if google_drive_image_file.md5_checksum:
+            key_prefix = f"{google_drive_image_file.md5_checksum}-q{quality}"
+            metadata = get_object_metadata(s3, bucket, key_prefix + ext)
+            if metadata is not None:
+                derivatives = json.loads(metadata.get("derivatives", "{}"))
+                if self._derivatives_match(derivatives, derivative_widths, with_webp):
+                    logger.info(f"Reusing existing S3 object {bucket}/{key_prefix}{ext}")
+                    return {
+                        "key": key_prefix + ext,
+                        "bucket": bucket,
+                        "region": get_bucket_region(s3, bucket),
+                        "meta": None,
+                        "derivatives": derivatives,
+                    }
         else:
+            key_prefix = str(uuid.uuid4())
+
+        res = self._get_drive_ops().download_item(google_drive_image_file)
+        if not res.ok:
+            res.close()
             raise FileNotFoundError
 
-    def _compress_image(self, image_path, quality=95, mimetype="image/jpeg"):
-        """Compresses image and replaces original image
+        # Images are buffered in memory, and only spill over to disk when they are large
+        original = SpooledBuffer(max_size=SPOOL_MAX_SIZE)
+        with res, original:
+            for chunk in res.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                original.write(chunk)
+            original.seek(0)
+
+            # ToDo: Handle non-jpeg
+            with Image.open(original) as img:
+                img.load()
+                image_format = img.format
+
+                derivatives = {}
+                for name, width in derivative_widths.items():
+                    derivative = img.copy()
+                    derivative.thumbnail((width, derivative.height), Image.LANCZOS)
+                    derivatives[name] = {
+                        "key": self._upload_image(
+                            s3,
+                            derivative,
+                            bucket,
+                            self._get_derivative_key(key_prefix, name, width, ext),
+                            image_format,
+                            mimetype,
+                            quality,
+                        ),
+                        "width": derivative.width,
+                        "height": derivative.height,
+                        # Images narrower than the configured width are not enlarged
+                        "max_width": width,
+                    }
+                    if with_webp:
+                        derivatives[name]["webp_key"] = self._upload_image(
+                            s3,
+                            derivative,
+                            bucket,
+                            self._get_derivative_key(key_prefix, name, width, ".webp"),
+                            "WEBP",
+                            "image/webp",
+                            quality,
+                        )
+
+                # The full size image is uploaded last and lists the derivatives, so its
+                # existence means that all of them have been uploaded
+                key = self._upload_image(
+                    s3,
+                    img,
+                    bucket,
+                    key_prefix + ext,
+                    image_format,
+                    mimetype,
+                    quality,
+                    metadata={"derivatives": json.dumps(derivatives)},
+                )
+
+            return {
+                "key": key,
+                "bucket": bucket,
+                "region": get_bucket_region(s3, bucket),
+                "meta": None,
+                "derivatives": derivatives,
+            }
+
+    def _upload_image(
+        self, s3, img, bucket, key, image_format, mimetype, quality, metadata=None
+    ) -> str:
+        """Compresses an image and uploads it to s3
+
+        Returns:
+            str -- the key of the uploaded image
+        """
+        compressed = SpooledBuffer(max_size=SPOOL_MAX_SIZE)
+        with compressed:
+            self._compress_image(img, compressed, image_format, quality=quality)
+            compressed.seek(0)
+            key, s3_res = upload_fileobj(
+                s3, compressed, bucket, mimetype, key=key, metadata=metadata
+            )
+        logger.info(f"Uploaded {key} to S3 with result {s3_res}")
+        return key
+
+    def _compress_image(self, img, destination, image_format, quality=95):
+        """Compresses an image, writing the result to a file object
 
         Keyword arguments:
-        image_path -- local path of image
+        img -- the decoded image
+        destination -- file object to write the compressed image to
+        image_format -- the format to encode the image in, e.g. "JPEG" or "WEBP"
         quality -- 0 to 100 (default: 95)
-        mimetype -- string (default: image/jpeg)
         """
-        if not os.path.exists(image_path):
-            raise FileNotFoundError
-        img = Image.open(image_path)
-        img.save(image_path, quality=quality, optimize=True)
+        if image_format == "WEBP" and img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.mode else "RGB")
+        img.save(destination, format=image_format, quality=quality, optimize=True)
+
+    @staticmethod
+    def _get_derivative_key(key_prefix: str, name: str, width: int, ext: str) -> str:
+        # The width is part of the key, so that a resized derivative never replaces a
+        # previous one that may still be cached or referenced by a package version
+        return f"{key_prefix}-{name}-w{width}{ext}"
+
+    @staticmethod
+    def _derivatives_match(derivatives: dict, derivative_widths: dict, with_webp: bool):
+        """Checks if the derivatives of a snapshotted image match the settings"""
+        if set(derivatives) != set(derivative_widths):
+            return False
+        for name, derivative in derivatives.items():
+            if derivative.get("max_width") != derivative_widths[name]:
+                return False
+            if ("webp_key" in derivative) != with_webp:
+                return False
+        return True
@@ -1,14 +1,19 @@
+import hashlib
+import json
 from datetime import datetime
-from typing import Optional
+from typing import Iterable, Optional
 
 import frontmatter
+from django.conf import settings
+from django.core.cache import cache
 from django.utils.dateparse import parse_datetime
-from markdown import Markdown
+from markdown import __version__ as markdown_version
 from rest_framework import serializers
 
 from kerckhoff.packages import constants
 from kerckhoff.packages.operations.parser import Parser
-from kerckhoff.packages.operations.s3_utils import get_public_link
+from kerckhoff.packages.operations.s3_utils import get_public_link, get_presigned_url
+from kerckhoff.packages.operations.utils import MarkdownConverter
 
 
 class ParsedContent:
@@ -16,15 +21,33 @@ class ParsedContent:
     html: str
     data: dict
 
-    def __init__(self, raw, format: str):
+    def __init__(self, raw, format: str, data: dict = None):
+        """
+        Arguments:
+            raw {str|bytes} -- the content to parse
+            format {str} -- the format of the content, e.g. FORMAT_AML
+
+        Keyword Arguments:
+            data {dict} -- the already parsed data of the content, see `from_stream`
+                (default: {None})
+        """
         try:
             # is bytes
             self.raw = raw.decode("utf-8")
         except AttributeError:
             # is str
             self.raw = raw
+        cache_key = self.get_cache_key(self.raw, format)
+        if data is None:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                self.html, self.data = cached
+                return
         try:
-            if format == FORMAT_MD:
+            if data is not None:
+                self.html = ""
+                self.data = data
+            elif format == FORMAT_MD:
                 file = frontmatter.loads(self.raw)
                 self.html = MarkdownParser.convert(file.content)
                 self.data = file.metadata
@@ -40,6 +63,49 @@ class ParsedContent:
         except Exception as err:
             self.html = ""
             self.data = {"status": 1, "content": {"Error": str(err)}}
+            return
+        cache.set(
+            cache_key, (self.html, self.data), settings.PACKAGES["PARSE_CACHE_TIMEOUT"]
+        )
+
+    @staticmethod
+    def get_cache_key(raw: str, format: str) -> str:
+        """Returns the key the parsed content is cached under
+
+        The key changes with the version of the parsers, so that content is parsed again
+        once they are upgraded.
+        """
+        digest = hashlib.sha256(raw.encode("utf-8")).hexdigest()
+        return f"parsed-content:{format}:{PARSERS_VERSION}:{digest}"
+
+    @classmethod
+    def from_stream(cls, chunks: Iterable[str], format: str) -> "ParsedContent":
+        """Parses content given as chunks of text, as they are read
+
+        ArchieML is parsed while the chunks are read, e.g. while they are downloaded.
+        Other formats are parsed once all of the content has been read.
+        """
+        if format != FORMAT_AML:
+            return cls("".join(chunks), format)
+
+        raw = []
+
+        def _read():
+            for chunk in chunks:
+                raw.append(chunk)
+                yield chunk
+
+        reader = _read()
+        try:
+            data = Parser().parse_stream(reader)
+        except Exception:
+            data = None
+        # The rest of the content is kept even if it was not parsed, e.g. after :ignore
+        for _ in reader:
+            pass
+        # Content which could not be parsed is parsed again for the error, which is
+        # neither cached nor expected often
+        return cls("".join(raw), format, data=data)
 
 
 class GoogleDriveFile:
@@ -50,6 +116,7 @@ class GoogleDriveFile:
     altLink: str
     last_modified_by: str
     last_modified_date: datetime
+    md5_checksum: Optional[str]
     _underlying: dict
     _code: str
 
@@ -59,23 +126,51 @@ class GoogleDriveFile:
             self.altLink = underlying["altLink"]
             self.last_modified_date = underlying["last_modified_date"]
             self.last_modified_by = underlying["last_modified_by"]
+            self.md5_checksum = underlying.get("md5_checksum")
         else:
             self.drive_id = underlying["id"]
             self.altLink = underlying["alternateLink"]
             self.last_modified_date = parse_datetime(underlying["modifiedDate"])
             self.last_modified_by = underlying["lastModifyingUser"]["displayName"]
+            # Only files with binary content (e.g. images) have a checksum on Google Drive
+            self.md5_checksum = underlying.get("md5Checksum")
 
         self._underlying = underlying
         self.title = underlying["title"]
         self.mimeType = underlying["mimeType"]
         self.selfLink = underlying["selfLink"]
 
-    def get_download_link(self) -> str:
+    def get_download_link(self, **kwargs) -> str:
         return self.selfLink + "?alt=media"
 
     def get_data_type(self) -> str:
         return constants.TEXT
 
+    def get_content_hash(self) -> Optional[str]:
+        """
+        Identifies the content of the file, files with the same content hash produce the same snapshot
+        :return: the content hash, or None if the content cannot be identified
+        """
+        return self.md5_checksum
+
+    def is_unchanged_since(self, serialized: dict) -> bool:
+        """
+        Checks if a previously serialized copy of this file still reflects the file on Google Drive
+        :param serialized: the serialized file, as produced by `to_json`
+        :return: True if the file has not been renamed or modified since it was serialized, nor
+            had its content replaced
+        """
+        last_modified_date = serializers.DateTimeField().to_representation(
+            self.last_modified_date
+        )
+        current = {
+            "drive_id": self.drive_id,
+            "title": self.title,
+            "last_modified_date": last_modified_date,
+            "md5_checksum": self.md5_checksum,
+        }
+        return all(serialized.get(field) == value for field, value in current.items())
+
     def to_json(self, **kwargs) -> dict:
         return GoogleDriveFileSerializer(self).data
 
@@ -113,8 +208,10 @@ class GoogleDriveTextFile(GoogleDriveFile):
         else:
             self.format = infer_format(self.title)
 
-    def get_download_link(self) -> str:
-        mime_type = "text/html" if self._is_rich else "text/plain"
+    def get_download_link(self, is_rich: Optional[bool] = None) -> str:
+        if is_rich is None:
+            is_rich = self._is_rich
+        mime_type = "text/html" if is_rich else "text/plain"
         return self.selfLink + f"/export?mimeType={mime_type}"
 
     def get_data_type(self) -> str:
@@ -131,8 +228,24 @@ class GoogleDriveTextFile(GoogleDriveFile):
     def from_json(cls, serialized: dict):
         return GoogleDriveTextFile(serialized, from_serialized=True)
 
+    def get_content_hash(self) -> Optional[str]:
+        serialized = self.to_json()
+        content = {
+            key: serialized.get(key)
+            for key in ("format", "content_plain", "content_rich")
+        }
+        return hashlib.sha256(
+            json.dumps(content, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
     def parse_content(self, raw: str, is_rich=False):
-        content = ParsedContent(raw, self.format)
+        self._set_content(ParsedContent(raw, self.format), is_rich)
+
+    def parse_stream(self, chunks: Iterable[str], is_rich=False):
+        """Parses the content of the file as it is read, see `ParsedContent.from_stream`"""
+        self._set_content(ParsedContent.from_stream(chunks, self.format), is_rich)
+
+    def _set_content(self, content: ParsedContent, is_rich: bool):
         if is_rich:
             self.content_rich = content
         else:
@@ -141,10 +254,13 @@ class GoogleDriveTextFile(GoogleDriveFile):
 
 class GoogleDriveImageFile(GoogleDriveFile):
     thumbnail_link: str
+    src_original: Optional[str]
     src_large: Optional[str]
     src_medium: Optional[str]
+    src_thumbnail: Optional[str]
     s3_key: Optional[str]
     s3_bucket: Optional[str]
+    derivatives: dict  # Resized copies of the image, see ImageUtils.snapshot_image
 
     _code = "GDRIVE_IMG"
 
@@ -154,17 +270,60 @@ class GoogleDriveImageFile(GoogleDriveFile):
             self.thumbnail_link = underlying["thumbnail_link"]
             self.s3_key = underlying.get("s3_key")
             self.s3_bucket = underlying.get("s3_bucket")
+            self.derivatives = underlying.get("derivatives") or {}
         else:
             self.thumbnail_link = underlying["thumbnailLink"]
+            self.derivatives = {}
 
     def get_data_type(self):
         return constants.IMAGE
 
+    def get_content_hash(self) -> Optional[str]:
+        """
+        Identifies the image and how it is snapshotted, so that unchanged images are
+        snapshotted again once the derivatives or the quality of snapshots change
+        :return: the content hash, or None if the image has no checksum
+        """
+        if not self.md5_checksum:
+            return None
+        snapshot_settings = json.dumps(
+            [
+                settings.PACKAGES["IMAGE_DERIVATIVES"],
+                settings.PACKAGES["IMAGE_WEBP_DERIVATIVES"],
+                settings.PACKAGES["IMAGE_QUALITY"],
+            ],
+            sort_keys=True,
+        )
+        return hashlib.md5(
+            f"{self.md5_checksum}:{snapshot_settings}".encode("utf-8")
+        ).hexdigest()
+
     def to_json(self, **kwargs) -> dict:
         if kwargs.get("refresh") and self.s3_key and self.s3_bucket:
-            self.src_large = get_public_link(self)
+            self.src_original = get_public_link(self)
+            self.derivatives = {
+                name: self._with_public_links(derivative)
+                for name, derivative in self.derivatives.items()
+            }
+            # Images snapshotted before derivatives existed only have the original
+            self.src_large = self._get_derivative_link("large") or self.src_original
+            self.src_medium = self._get_derivative_link("medium")
+            self.src_thumbnail = self._get_derivative_link("thumbnail")
         return GoogleDriveImageFileSerializer(self).data
 
+    def _with_public_links(self, derivative: dict) -> dict:
+        derivative = dict(
+            derivative, src=get_presigned_url(self.s3_bucket, derivative["key"])
+        )
+        if derivative.get("webp_key"):
+            derivative["webp_src"] = get_presigned_url(
+                self.s3_bucket, derivative["webp_key"]
+            )
+        return derivative
+
+    def _get_derivative_link(self, name: str) -> Optional[str]:
+        return self.derivatives.get(name, {}).get("src")
+
     @classmethod
     def from_json(cls, serialized: dict):
         return GoogleDriveImageFile(serialized, from_serialized=True)
@@ -174,6 +333,7 @@ class GoogleDriveImageFile(GoogleDriveFile):
         res = image_utils.snapshot_image(self)
         self.s3_key = res["key"]
         self.s3_bucket = res["bucket"]
+        self.derivatives = res.get("derivatives", {})
         return self.to_json(refresh=True)
 
 
@@ -193,6 +353,7 @@ class GoogleDriveFileSerializer(serializers.Serializer):
     altLink = serializers.URLField()
     last_modified_by = serializers.EmailField()
     last_modified_date = serializers.DateTimeField()
+    md5_checksum = serializers.CharField(required=False, allow_null=True)
     _code = serializers.CharField()
 
 
@@ -210,10 +371,13 @@ class GoogleDriveTextFileSerializer(GoogleDriveFileSerializer):
 
 class GoogleDriveImageFileSerializer(GoogleDriveFileSerializer):
     thumbnail_link = serializers.URLField()
+    src_original = serializers.CharField(required=False)
     src_large = serializers.CharField(required=False)
-    src_medium = serializers.CharField(required=False)
+    src_medium = serializers.CharField(required=False, allow_null=True)
+    src_thumbnail = serializers.CharField(required=False, allow_null=True)
     s3_key = serializers.CharField(required=False)
     s3_bucket = serializers.CharField(required=False)
+    derivatives = serializers.JSONField(required=False)
 
 
 # Utils
@@ -224,7 +388,31 @@ FORMAT_PLAIN = "PLAIN"
 
 FormatTable = {"aml": FORMAT_AML, "md": FORMAT_MD}
 
-MarkdownParser = Markdown()
+# Exports of a content file downloaded from Google Drive
+EXPORT_PLAIN = "plain"  # the plain text export only
+EXPORT_RICH = "rich"  # the HTML export only, the plain content is derived from it
+EXPORT_BOTH = "both"  # both the plain text and HTML exports
+EXPORT_POLICIES = (EXPORT_PLAIN, EXPORT_RICH, EXPORT_BOTH)
+
+# The exports downloaded for each format, unless a package set overrides them. ArchieML
+# keeps both exports, as consumers may read the HTML of its values from content_rich, but
+# package sets which only use its data can set it to plain. Markdown has no HTML export.
+DEFAULT_EXPORT_POLICIES = {
+    FORMAT_AML: EXPORT_BOTH,
+    FORMAT_MD: EXPORT_PLAIN,
+    FORMAT_PLAIN: EXPORT_RICH,
+}
+# Formats which may only be downloaded with their default export policy
+FIXED_EXPORT_POLICY_FORMATS = (FORMAT_MD,)
+
+MarkdownParser = MarkdownConverter(
+    extensions=settings.PACKAGES["MARKDOWN_EXTENSIONS"]
+)
+
+# Identifies the parsers used by ParsedContent, see ParsedContent.get_cache_key
+PARSERS_VERSION = "aml{}-md{}-{}".format(
+    Parser.VERSION, markdown_version, ",".join(settings.PACKAGES["MARKDOWN_EXTENSIONS"])
+)
 
 
 def infer_format(file_title: str) -> str:
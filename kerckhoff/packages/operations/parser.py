@@ -1,7 +1,31 @@
+import re
 from collections import namedtuple
-from typing import Any, List, NamedTuple
-
-from kerckhoff.packages.operations.utils import squash_prefix
+from typing import Any, Iterable, Iterator, List, NamedTuple, Tuple
+
+from requests import Response
+
+from kerckhoff.packages.operations.utils import decode_chunks, squash_prefix
+
+# Size of the chunks read from responses and files when parsing them as a stream
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Classifies a line by its first significant characters, in order of precedence:
+# commands (e.g. ":endskip"), list items, possible key/value pairs (any line with a
+# colon), blocks ("{key}") and arrays ("[key]"). Lines matching none are comments.
+_LINE_RE = re.compile(
+    r"""
+    \s*(?:
+        :(?P<command>(?i:endskip|end|skip|ignore))
+      | (?P<list_item>\*)
+    )
+  | (?P<key>[^:]*):
+  | \s*\{(?P<block>[^}]*)\}
+  | \s*\[(?P<array>[^\]]*)\]
+    """,
+    re.VERBOSE,
+)
+# Characters which are not allowed in keys, blocks and array names
+_SPECIALS_RE = re.compile(r"[\[\]\\{}]")
 
 
 class Parser(object):
@@ -15,6 +39,9 @@ class Parser(object):
     _skip: bool
 
     _depth: List[NamedTuple]
+    # The container of every resolved scope in _depth, and whether the following scope
+    # is the value of a freeform item, see _get_current_ref
+    _scope_refs: List[Tuple[Any, bool]]
     _val: dict
 
     SomeList = namedtuple("SomeList", "id")
@@ -24,6 +51,11 @@ class Parser(object):
 
     Namespace = namedtuple("Namespace", "id")
 
+    _LIST_SCOPES = (SomeList, ObjectList, StringList, FreeformList)
+
+    # Bump whenever the output of the parser changes, to invalidate cached results
+    VERSION = 1
+
     def __init__(self, *args, **kwargs):
         self._reset()
         super().__init__(*args, **kwargs)
@@ -31,7 +63,7 @@ class Parser(object):
     # Helper Functions
 
     def _reset(self):
-        self._depth = list()
+        self._clear_scopes()
         self._buffer = ""
         self._val = dict()
         self._last_ref = None
@@ -43,26 +75,44 @@ class Parser(object):
         self._last_ref = None
         self._last_key = None
 
+    def _push_scope(self, scope: NamedTuple):
+        self._depth.append(scope)
+
+    def _pop_scope(self) -> NamedTuple:
+        scope = self._depth.pop()
+        depth = len(self._depth)
+        del self._scope_refs[depth:]
+        return scope
+
+    def _replace_scope(self, scope: NamedTuple):
+        """Replaces the innermost scope with one of the same id and container"""
+        self._depth[-1] = scope
+
+    def _clear_scopes(self):
+        self._depth = list()
+        self._scope_refs = list()
+
     def _get_current_ref(self):
-        ref = self._val
-        in_freeform = False
-        for scope in self._depth:
-            if in_freeform:
-                ref = ref[-1]
-                assert ref.get("type") == scope.id
-                ref = ref.get("value")
-                in_freeform = False
-            else:
-                levels = scope.id.split(".")
-                for level in levels:
-                    if isinstance(ref, list):
-                        ref = ref[-1]
-                    ref = ref.get(level)
-                if isinstance(scope, self.FreeformList):
-                    in_freeform = True
+        # Scopes are resolved once, the first time they are used
+        for index in range(len(self._scope_refs), len(self._depth)):
+            self._scope_refs.append(self._resolve_scope(index))
+        ref = self._scope_refs[-1][0] if self._scope_refs else self._val
         assert ref is not None
         return ref
 
+    def _resolve_scope(self, index: int) -> Tuple[Any, bool]:
+        scope = self._depth[index]
+        ref, in_freeform = self._scope_refs[index - 1] if index else (self._val, False)
+        if in_freeform:
+            ref = ref[-1]
+            assert ref.get("type") == scope.id
+            return ref.get("value"), False
+        for level in scope.id.split("."):
+            if isinstance(ref, list):
+                ref = ref[-1]
+            ref = ref.get(level)
+        return ref, isinstance(scope, self.FreeformList)
+
     def _access_or_create(self, key: str, thing):
         loc = None
         if isinstance(thing, dict):
@@ -106,7 +156,7 @@ class Parser(object):
         return ref
 
     def _is_array_type(self) -> bool:
-        return len(self._depth) > 0 and ("List" in type(self._depth[-1]).__name__)
+        return len(self._depth) > 0 and isinstance(self._depth[-1], self._LIST_SCOPES)
 
     def _is_freeform_array(self) -> bool:
         return len(self._depth) > 0 and isinstance(self._depth[-1], self.FreeformList)
@@ -121,8 +171,7 @@ class Parser(object):
         if self._is_array_type():
             if isinstance(self._depth[-1], self.SomeList):
                 self._clear_buffer()
-                old_list = self._depth.pop()
-                self._depth.append(self.StringList(old_list.id))
+                self._replace_scope(self.StringList(self._depth[-1].id))
                 ref = self._append_string_value(value)
                 self._last_ref = ref
                 self._last_key = 0
@@ -142,8 +191,8 @@ class Parser(object):
             self._handle_comment(line)
 
     def _handle_pair(self, line):
-        key = line.split(":")[0]
-        value = ':'.join(line.split(":")[1:]).lstrip()
+        key, _, value = line.partition(":")
+        value = value.lstrip()
         key = key.strip()
         value_whitespace = value[len(value.rstrip()):]
         value = value.rstrip()
@@ -161,8 +210,7 @@ class Parser(object):
             ref = None
             if isinstance(list_context, self.SomeList):
                 self._clear_buffer()
-                self._depth.pop()
-                self._depth.append(self.ObjectList(list_context.id, key))
+                self._replace_scope(self.ObjectList(list_context.id, key))
                 ref = self._set_value(key_layers, value)
                 self._handle_comment(value_whitespace)
             elif isinstance(list_context, self.ObjectList):
@@ -203,18 +251,18 @@ class Parser(object):
             # blocks with preceding . only works in freeform arrays
             if self._is_freeform_array():
                 self._append_freeform_value(dict(), key[1:])
-                self._depth.append(self.Namespace(key[1:]))
+                self._push_scope(self.Namespace(key[1:]))
             pass
         else:
-            self._depth = list()
+            self._clear_scopes()
             self._set_value(key_list, dict(), replace=False)
-            self._depth.append(self.Namespace(key))
+            self._push_scope(self.Namespace(key))
 
     def _handle_end_block(self):
         if not self._depth:
             pass
         else:
-            self._depth.pop()
+            self._pop_scope()
 
     def _handle_start_array(self, line):
         key = line.split("]")[0][1:].strip()
@@ -232,8 +280,7 @@ class Parser(object):
                 current_context = self._depth[-1]
                 if isinstance(current_context, self.SomeList):
                     self._set_value(key_list[1:], list())
-                    parent_list = self._depth.pop()
-                    self._depth.append(self.ObjectList(parent_list.id, proper_key))
+                    self._replace_scope(self.ObjectList(current_context.id, proper_key))
                 elif isinstance(current_context, self.ObjectList):
                     if current_context.first_key == proper_key:
                         self._get_current_ref().append(dict())
@@ -243,30 +290,30 @@ class Parser(object):
                 elif isinstance(current_context, self.Namespace):
                     self._set_value(key_list[1:], list())
                 else:  # StringList
-                    self._depth.pop()
+                    self._pop_scope()
                     self._set_value(key_list[1:], list())
                 if is_freeform:
-                    self._depth.append(self.FreeformList(proper_key))
+                    self._push_scope(self.FreeformList(proper_key))
                 else:
-                    self._depth.append(self.SomeList(proper_key))
+                    self._push_scope(self.SomeList(proper_key))
             else:
                 self._set_value(key_list[1:], list())
                 if is_freeform:
-                    self._depth.append(self.FreeformList(proper_key))
+                    self._push_scope(self.FreeformList(proper_key))
                 else:
-                    self._depth.append(self.SomeList(proper_key))
+                    self._push_scope(self.SomeList(proper_key))
         else:
             # ends this
-            self._depth = list()
+            self._clear_scopes()
             self._set_value(key_list, list())
             if is_freeform:
-                self._depth.append(self.FreeformList(key))
+                self._push_scope(self.FreeformList(key))
             else:
-                self._depth.append(self.SomeList(key))
+                self._push_scope(self.SomeList(key))
 
     def _handle_end_array(self):
         if self._is_array_type():
-            self._depth.pop()
+            self._pop_scope()
 
     def _handle_skip(self):
         self._skip = True
@@ -311,54 +358,105 @@ class Parser(object):
             return fn(command)
 
     def get_dict(self, document) -> dict:
+        return self._parse_lines(document.split("\n"))
+
+    def parse_lines(self, lines: Iterable[str]) -> dict:
+        """Parses a document given line by line, with or without line endings"""
+        return self._parse_lines(
+            line[:-1] if line.endswith("\n") else line for line in lines
+        )
+
+    def parse_stream(self, chunks: Iterable[str]) -> dict:
+        """Parses a document given as chunks of text of any size, as they are read
+
+        This allows documents to be parsed while they are downloaded, without holding
+        the entire document in memory.
+        """
+        return self._parse_lines(_split_lines(chunks))
+
+    def _parse_lines(self, lines: Iterable[str]) -> dict:
         self._reset()
-        specials = ['[', ']', '\\', '{', '}']
-        for line in document.split("\n"):
+        for line in lines:
             line += "\n"
-            stripped = line.strip()
-            lstripped = line.lstrip()
-            if stripped.lower().startswith(":endskip"):
+            match = _LINE_RE.match(line)
+            command = match and match.group("command")
+            if command and command.lower() == "endskip":
                 self._handle_end_skip()
-            elif not self._skip:
-                if stripped.lower().startswith(":end"):
+            elif self._skip:
+                continue
+            elif command:
+                command = command.lower()
+                if command == "end":
                     self._handle_end_multiline()
-                    # self._handle_end_block()
-                elif stripped.lower().startswith(":skip"):
+                elif command == "skip":
                     self._handle_skip()
-                elif stripped.lower().startswith(":ignore"):
+                else:
                     self._handle_ignore()
                     break
-                elif stripped and stripped.startswith("*"):
-                    self._handle_list_item(line)
-                elif stripped and len(line.split(":")) >= 2:
-                    # Is possible key pair
-                    key = line.split(":")[0]
-                    if key and " " not in key.strip() and all([s not in key for s in specials]):
-                        self._handle_pair(line)
-                    else:
-                        self._handle_comment(line)
-                elif stripped and stripped[0] == '{' and '}' in stripped:
-                    command = stripped.split("}")[0][1:].strip()
-                    if not command:
-                        self._handle_end_block()
-                    elif all([s not in command for s in specials]):
-                        self._handle_start_block(lstripped)
-                    else:
-                        self._handle_comment(lstripped)
-                elif stripped and stripped[0] == '[' and ']' in stripped:
-                    command = stripped.split("]")[0][1:].strip()
-                    if not command:
-                        self._handle_end_array()
-                    elif all([s not in command for s in specials]):
-                        self._handle_start_array(lstripped)
-                    else:
-                        self._handle_comment(line)
+            elif match is None:
+                self._handle_comment(line)
+            elif match.group("list_item"):
+                self._handle_list_item(line)
+            elif match.group("key") is not None:
+                # Is possible key pair
+                key = match.group("key")
+                if key and " " not in key.strip() and not _SPECIALS_RE.search(key):
+                    self._handle_pair(line)
+                else:
+                    self._handle_comment(line)
+            elif match.group("block") is not None:
+                block = match.group("block").strip()
+                if not block:
+                    self._handle_end_block()
+                elif not _SPECIALS_RE.search(block):
+                    self._handle_start_block(line.lstrip())
+                else:
+                    self._handle_comment(line.lstrip())
+            else:
+                array = match.group("array").strip()
+                if not array:
+                    self._handle_end_array()
+                elif not _SPECIALS_RE.search(array):
+                    self._handle_start_array(line.lstrip())
                 else:
                     self._handle_comment(line)
         return self._val
 
     def parse(self, input_to_parse) -> dict:
+        """Parses an ArchieML document
+
+        Arguments:
+            input_to_parse -- the document, as a str, a streamed requests Response or a
+                file-like object (both read in chunks), or an iterable of lines
+        """
         if isinstance(input_to_parse, str):
             return self.get_dict(input_to_parse)
+        elif isinstance(input_to_parse, Response):
+            chunks = input_to_parse.iter_content(STREAM_CHUNK_SIZE)
+            return self.parse_stream(decode_chunks(chunks))
+        elif hasattr(input_to_parse, "read"):
+            return self.parse_stream(decode_chunks(_read_chunks(input_to_parse)))
+        elif isinstance(input_to_parse, Iterable):
+            return self.parse_lines(input_to_parse)
         else:
-            raise NotImplementedError("The parser currently only supports strings!")
+            raise NotImplementedError(
+                f"The parser does not support {type(input_to_parse).__name__}"
+            )
+
+
+def _split_lines(chunks: Iterable[str]) -> Iterator[str]:
+    """Splits chunks of text on newlines, like str.split on the whole text would"""
+    pending = ""
+    for chunk in chunks:
+        lines = (pending + chunk).split("\n")
+        pending = lines.pop()
+        yield from lines
+    yield pending
+
+
+def _read_chunks(fileobj) -> Iterator:
+    while True:
+        chunk = fileobj.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
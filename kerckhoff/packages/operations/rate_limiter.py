@@ -0,0 +1,157 @@
+import logging
+import threading
+import time
+
+import newrelic.agent
+from django.conf import settings
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+# Refills the bucket for the time elapsed since it was last used, applies the penalty
+# and takes the requested tokens if there are enough of them. Returns the number of
+# seconds to wait before the tokens can be taken.
+_TOKEN_BUCKET_SCRIPT = """
+redis.replicate_commands()
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local penalty = tonumber(ARGV[4])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local state = redis.call("HMGET", KEYS[1], "tokens", "updated_at")
+local tokens = tonumber(state[1]) or capacity
+local updated_at = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+if penalty > 0 then
+    tokens = math.min(tokens, -penalty * rate)
+end
+
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+
+redis.call("HMSET", KEYS[1], "tokens", tostring(tokens), "updated_at", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate + penalty) + 1)
+return tostring(wait)
+"""
+
+
+class TokenBucket:
+    """A token bucket rate limiter
+
+    The bucket is shared by every process through Redis when the default cache is backed
+    by Redis, and is local to the process otherwise (e.g. in development).
+    """
+
+    def __init__(self, key: str, rate: float, capacity: float):
+        """
+        Arguments:
+            key {str} -- identifies the bucket
+            rate {float} -- the number of tokens added to the bucket every second
+            capacity {float} -- the maximum number of tokens, i.e. the allowed burst
+        """
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+        self._script = _get_token_bucket_script()
+        self._lock = threading.Lock()
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+
+    def acquire(self, tokens: int = 1) -> float:
+        """Takes tokens from the bucket, waiting until they are available
+
+        More tokens than the capacity of the bucket are taken a bucketful at a time.
+
+        Keyword Arguments:
+            tokens {int} -- the number of tokens to take (default: {1})
+
+        Returns:
+            float -- the number of seconds spent waiting
+        """
+        waited = 0.0
+        while tokens > 0:
+            requested = min(tokens, self.capacity)
+            wait = self._take(requested, 0)
+            if wait <= 0:
+                tokens -= requested
+                continue
+            time.sleep(wait)
+            waited += wait
+        return waited
+
+    def pause(self, seconds: float):
+        """Empties the bucket so that no token is available for the next `seconds`"""
+        self._take(0, seconds)
+
+    def _take(self, requested: float, penalty: float) -> float:
+        if self._script is not None:
+            return float(
+                self._script(
+                    keys=[self.key], args=[self.rate, self.capacity, requested, penalty]
+                )
+            )
+
+        with self._lock:
+            now = time.monotonic()
+            tokens = min(
+                self.capacity, self._tokens + (now - self._updated_at) * self.rate
+            )
+            if penalty > 0:
+                tokens = min(tokens, -penalty * self.rate)
+            wait = 0.0
+            if tokens >= requested:
+                tokens -= requested
+            else:
+                wait = (requested - tokens) / self.rate
+            self._tokens, self._updated_at = tokens, now
+            return wait
+
+
+_user_buckets = {}
+_user_buckets_lock = threading.Lock()
+
+
+def get_user_rate_limiter(user_id) -> TokenBucket:
+    """Returns the bucket limiting the Google Drive requests made for a user"""
+    with _user_buckets_lock:
+        if user_id not in _user_buckets:
+            _user_buckets[user_id] = TokenBucket(
+                f"gdrive-rate-limit:{user_id}",
+                settings.GOOGLE_OAUTH["DRIVE_RATE_LIMIT"],
+                settings.GOOGLE_OAUTH["DRIVE_RATE_LIMIT_BURST"],
+            )
+        return _user_buckets[user_id]
+
+
+def record_quota_usage(waited: float, throttled: int, requests: int = 1):
+    """Reports Google Drive requests, and how they were rate limited, to New Relic
+
+    Arguments:
+        waited {float} -- the seconds spent waiting for the rate limit
+        throttled {int} -- the number of requests rejected by the rate limits of Google
+
+    Keyword Arguments:
+        requests {int} -- the number of requests made, e.g. the parts of a batch
+            (default: {1})
+    """
+    if requests:
+        newrelic.agent.record_custom_metric("Custom/GoogleDrive/Requests", requests)
+        newrelic.agent.record_custom_metric("Custom/GoogleDrive/RateLimitWait", waited)
+    if throttled:
+        newrelic.agent.record_custom_metric(
+            "Custom/GoogleDrive/Throttled", int(throttled)
+        )
+
+
+def _get_token_bucket_script():
+    try:
+        return get_redis_connection("default").register_script(_TOKEN_BUCKET_SCRIPT)
+    except NotImplementedError:
+        # The default cache is not backed by Redis
+        return None
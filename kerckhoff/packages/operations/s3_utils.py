@@ -1,15 +1,25 @@
 import logging
 import mimetypes
-import os
+import threading
 import uuid
+from typing import Optional
 
 import boto3
+from botocore.exceptions import ClientError
 from django.conf import settings
+from django.core.cache import cache
 
 logger = logging.getLogger(__name__)
 
 _global_s3_client = None
 
+# Fraction of a presigned url's validity during which it is reused
+PRESIGNED_URL_REUSE_RATIO = 0.8
+
+# Bucket name -> region, see get_bucket_region
+_bucket_regions = {}
+_bucket_regions_lock = threading.Lock()
+
 
 def get_s3_client():
     global _global_s3_client
@@ -24,27 +34,77 @@ def get_s3_client():
     return _global_s3_client
 
 
-def upload_file(s3_client, image_path, bucket, mimetype):
-    if not os.path.exists(image_path):
-        raise FileNotFoundError(image_path)
-    key = str(uuid.uuid4()) + mimetypes.guess_extension(mimetype)
+def upload_fileobj(s3_client, fileobj, bucket, mimetype, key=None, metadata=None):
+    """Uploads a file-like object to S3, using a multipart upload for large files"""
+    if key is None:
+        key = str(uuid.uuid4()) + mimetypes.guess_extension(mimetype)
     args = {"ContentType": mimetype}
-    res = s3_client.upload_file(image_path, bucket, key, ExtraArgs=args)
-    logger.debug("Uploaded {0} to {1}/{2}".format(image_path, bucket, key))
+    if metadata:
+        args["Metadata"] = metadata
+    res = s3_client.upload_fileobj(fileobj, bucket, key, ExtraArgs=args)
+    logger.debug("Uploaded file object to {0}/{1}".format(bucket, key))
     return key, res
 
 
+def get_object_metadata(s3_client, bucket, key) -> Optional[dict]:
+    """Returns the user metadata of an S3 object, or None if the object does not exist
+
+    Without s3:ListBucket, S3 answers a HEAD for a missing key with 403 instead of 404.
+    Credentials that are only allowed to upload (s3:PutObject) get a 403 for every key,
+    so it is treated as missing too and the object is uploaded again.
+    """
+    try:
+        res = s3_client.head_object(Bucket=bucket, Key=key)
+    except ClientError as err:
+        if err.response.get("Error", {}).get("Code") in (
+            "403",
+            "404",
+            "AccessDenied",
+            "NoSuchKey",
+        ):
+            return None
+        raise
+    return res.get("Metadata", {})
+
+
 def get_public_link(google_drive_image_file: "GoogleDriveImageFile", duration=3600):
-    s3 = get_s3_client()
-    return s3.generate_presigned_url(
-        "get_object",
-        Params={
-            "Bucket": google_drive_image_file.s3_bucket,
-            "Key": google_drive_image_file.s3_key,
-        },
-        ExpiresIn=duration,
+    return get_presigned_url(
+        google_drive_image_file.s3_bucket, google_drive_image_file.s3_key, duration
     )
 
 
+def get_presigned_url(bucket, key, duration=3600):
+    """Returns a presigned GET url for an S3 object
+
+    Signed urls are cached and handed out again until PRESIGNED_URL_REUSE_RATIO of their
+    validity has elapsed, so every url returned is valid for at least the remaining time.
+    """
+    cache_key = f"s3-presigned-url:{bucket}:{key}:{duration}"
+    url = cache.get(cache_key)
+    if url is None:
+        s3 = get_s3_client()
+        url = s3.generate_presigned_url(
+            "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=duration
+        )
+        cache.set(cache_key, url, int(duration * PRESIGNED_URL_REUSE_RATIO))
+    return url
+
+
 def get_bucket_region(s3_client, bucket):
-    return s3_client.get_bucket_location(Bucket=bucket)["LocationConstraint"]
+    """Returns the region of a bucket, looked up once per process"""
+    with _bucket_regions_lock:
+        if not _bucket_regions:
+            _bucket_regions.update(_get_configured_bucket_regions())
+        if bucket not in _bucket_regions:
+            _bucket_regions[bucket] = s3_client.get_bucket_location(Bucket=bucket)[
+                "LocationConstraint"
+            ]
+        return _bucket_regions[bucket]
+
+
+def _get_configured_bucket_regions() -> dict:
+    bucket = settings.AWS_CONFIG["MEDIA_BUCKET_NAME"]
+    region = settings.AWS_CONFIG.get("MEDIA_BUCKET_REGION")
+    if bucket and region:
+        return {bucket: region}
+    return {}
@@ -1,94 +1,177 @@
-from bleach.sanitizer import Cleaner
+from bleach.sanitizer import BleachSanitizerFilter, Cleaner
 from html5lib.filters.base import Filter
+from markdown import Markdown
+from typing import Iterable, Iterator, Union
 from urllib.parse import parse_qs, urlparse
+import codecs
+import html
 import re
+import threading
 
 TAGS = ["a", "p", "span", "em", "strong"]
 ATTRS = {"span": ["style"], "a": ["href"]}
 STYLES = ["font-weight", "font-style", "text-decoration"]
 
 
-class KeepOnlyInterestingSpans(Filter):
-    drop_next_close = False
+# A property and its value in a style attribute, as matched by the sanitizer
+_STYLE_PROPERTY_RE = re.compile(r"([-\w]+)\s*:\s*([^:;]*)")
+# Values of the allowed style properties which are the default, i.e. do not style
+_BORING_STYLES = {
+    "font-weight": ("400", "normal"),
+    "text-decoration": ("none",),
+    "font-style": ("normal",),
+}
 
-    def _style_is_boring(self, prop, value):
-        boring_styles = {
-            "font-weight": ["400", "normal"],
-            "text-decoration": ["none"],
-            "font-style": ["normal"],
-        }
 
-        return value in boring_styles.get(prop, [])
+class CleanGoogleDocTokens(Filter):
+    """Cleans the tokens of a Google Docs export in a single pass
 
-    def _reduce_to_interesting_styles(self, token):
-        styles = token["data"].get((None, "style"))
-        if styles is not None:
-            final_styles = ""
-            for prop, value in re.findall(r"([-\w]+)\s*:\s*([^:;]*)", styles):
-                if not self._style_is_boring(prop, value):
-                    final_styles += "%s:%s;" % (prop, value)
-            token["data"][(None, "style")] = final_styles
-            return final_styles
-        return ""
+    - spans with no interesting style (e.g. only "font-weight:400") are unwrapped
+    - paragraphs are converted to newlines
+    - the Google redirect is removed from links
+    """
+
+    NEWLINE_TOKEN = {"type": "Characters", "data": "\n"}
 
     def __iter__(self):
+        drop_next_close = False
+        # Exports repeat the same few styles for every span
+        reduced_styles = {}
         for token in Filter.__iter__(self):
-            if token["type"] == "StartTag" and token["name"] == "span":
-                if not token["data"]:
-                    drop_next_close = True
+            token_type = token["type"]
+            if token_type == "StartTag":
+                name = token["name"]
+                if name == "span":
+                    data = token["data"]
+                    styles = data.get((None, "style")) if data else None
+                    if styles is None:
+                        drop_next_close = True
+                        continue
+                    reduced = reduced_styles.get(styles)
+                    if reduced is None:
+                        reduced = reduced_styles[styles] = self._reduce_styles(styles)
+                    data[(None, "style")] = reduced
+                    if reduced == "":
+                        drop_next_close = True
+                        continue
+                elif name == "p":
                     continue
-
-                reduced_styles = self._reduce_to_interesting_styles(token)
-                # print("final:", token)
-                if reduced_styles == "":
-                    drop_next_close = True
+                elif name == "a" and token["data"]:
+                    url = token["data"].get((None, "href"))
+                    if url is not None:
+                        actual_url = parse_qs(urlparse(url).query).get("q")
+                        if actual_url:
+                            token["data"][(None, "href")] = actual_url[0]
+            elif token_type == "EndTag":
+                name = token["name"]
+                if name == "span" and drop_next_close:
+                    drop_next_close = False
+                    continue
+                elif name == "p":
+                    yield self.NEWLINE_TOKEN
                     continue
-            elif (
-                token["type"] == "EndTag"
-                and token["name"] == "span"
-                and drop_next_close
-            ):
-                drop_next_close = False
-                continue
-            yield (token)
+            yield token
+
+    @staticmethod
+    def _reduce_styles(styles: str) -> str:
+        return "".join(
+            "%s:%s;" % (prop, value)
+            for prop, value in _STYLE_PROPERTY_RE.findall(styles)
+            if value not in _BORING_STYLES.get(prop, ())
+        )
+
+
+class _MemoizedSanitizerFilter(BleachSanitizerFilter):
+    """Sanitizes each distinct style attribute of a document once"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sanitized_css = {}
+
+    def sanitize_css(self, style):
+        sanitized = self._sanitized_css.get(style)
+        if sanitized is None:
+            sanitized = self._sanitized_css[style] = super().sanitize_css(style)
+        return sanitized
+
+
+class GoogleDocCleaner(Cleaner):
+    """A bleach Cleaner which sanitizes every distinct style attribute once
+
+    Mirrors Cleaner.clean of bleach 3.1, only with the sanitizer filter replaced.
+    """
+
+    def clean(self, text: str) -> str:
+        if not isinstance(text, str):
+            raise TypeError(
+                "argument cannot be of '{name}' type, must be of text type".format(
+                    name=text.__class__.__name__
+                )
+            )
+        if not text:
+            return ""
+
+        dom = self.parser.parseFragment(text)
+        filtered = _MemoizedSanitizerFilter(
+            source=self.walker(dom),
+            attributes=self.attributes,
+            strip_disallowed_elements=self.strip,
+            strip_html_comments=self.strip_comments,
+            allowed_elements=self.tags,
+            allowed_css_properties=self.styles,
+            allowed_protocols=self.protocols,
+            allowed_svg_properties=[],
+        )
+        for filter_class in self.filters:
+            filtered = filter_class(source=filtered)
+
+        return self.serializer.render(filtered)
+
+
+GoogleDocHTMLCleaner: Cleaner = GoogleDocCleaner(
+    tags=TAGS,
+    attributes=ATTRS,
+    styles=STYLES,
+    strip=True,
+    filters=[CleanGoogleDocTokens],
+)
 
 
-class ConvertPTagsToNewlines(Filter):
-    NEWLINE_TOKEN = {"type": "Characters", "data": "\n"}
+class MarkdownConverter:
+    """Converts Markdown to HTML, safely from any number of threads
 
-    def __iter__(self):
-        for token in Filter.__iter__(self):
-            if token["type"] == "StartTag" and token["name"] == "p":
-                continue
-            elif token["type"] == "EndTag" and token["name"] == "p":
-                yield (self.NEWLINE_TOKEN)
-                continue
-            yield (token)
+    Markdown instances keep the state of the last conversion (e.g. footnotes and
+    references), so each thread converts with its own instance, which is reset before
+    every conversion.
+    """
 
+    def __init__(self, **options):
+        """
+        Keyword Arguments:
+            options -- passed to every Markdown instance, e.g. extensions
+        """
+        self.options = options
+        self._local = threading.local()
 
-class RemoveGoogleTrackingFromHrefs(Filter):
-    def __iter__(self):
-        for token in Filter.__iter__(self):
-            if token["type"] == "StartTag" and token["name"] == "a" and token["data"]:
-                url = token["data"].get((None, "href"))
-                if url is not None:
-                    actual_url = parse_qs(urlparse(url).query).get("q")
-                    if actual_url is not None and len(actual_url) > 0:
-                        token["data"][(None, "href")] = actual_url[0]
-            yield (token)
+    def convert(self, text: str) -> str:
+        markdown = getattr(self._local, "markdown", None)
+        if markdown is None:
+            markdown = self._local.markdown = Markdown(**self.options)
+        return markdown.reset().convert(text)
 
 
-GoogleDocHTMLCleaner: Cleaner = Cleaner(
-    tags=TAGS,
-    attributes=ATTRS,
-    styles=STYLES,
-    strip=True,
-    filters=[
-        KeepOnlyInterestingSpans,
-        ConvertPTagsToNewlines,
-        RemoveGoogleTrackingFromHrefs,
-    ],
-)
+# A tag of the HTML serialized by GoogleDocHTMLCleaner, which escapes "<" and ">"
+_TAG_RE = re.compile(r"<[^>]*>")
+
+
+def html_to_text(cleaned_html: str) -> str:
+    """Converts the output of GoogleDocHTMLCleaner to plain text
+
+    Paragraphs are already newlines, so the remaining tags are stripped and entities are
+    unescaped. Unlike the plain text export of a document, list items are not bulleted.
+    """
+    return html.unescape(_TAG_RE.sub("", cleaned_html))
+
 
 def squash_prefix(prefix: str, to_squash: str) -> str:
     def _squash_prefix(prefix: str, to_squash: str) -> str:
@@ -101,3 +184,21 @@ def squash_prefix(prefix: str, to_squash: str) -> str:
         return _squash_prefix(prefix, to_squash)
     else:
         return to_squash
+
+
+def decode_chunks(
+    chunks: Iterable[Union[bytes, str]], encoding: str = "utf-8-sig"
+) -> Iterator[str]:
+    """Decodes a stream of bytes chunk by chunk, chunks which are already text are kept
+
+    Characters split across chunks are decoded once all of their bytes are read. The
+    default encoding drops the byte order mark that Google Drive adds to text exports.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    for chunk in chunks:
+        text = decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
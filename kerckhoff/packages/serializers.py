@@ -2,7 +2,12 @@ from rest_framework import serializers
 from rest_framework.validators import UniqueTogetherValidator
 
 from kerckhoff.integrations.serializers import IntegrationSerializer
-from .models import PackageSet, Package, PackageVersion, PackageItem
+from .models import EXPORT_POLICIES_KEY, PackageSet, Package, PackageVersion, PackageItem
+from .operations.models import (
+    DEFAULT_EXPORT_POLICIES,
+    EXPORT_POLICIES,
+    FIXED_EXPORT_POLICY_FORMATS,
+)
 from kerckhoff.users.serializers import UserSerializer, SimpleUserSerializer
 
 from taggit_serializer.serializers import TagListSerializerField, TaggitSerializer
@@ -16,6 +21,32 @@ class PackageSetSerializer(serializers.ModelSerializer):
         fields = ("id", "slug", "metadata", "created_by", "created_at", "updated_at")
         read_only_fields = ("id", "created_by", "created_at", "updated_at")
 
+    def validate_metadata(self, value):
+        overrides = value.get(EXPORT_POLICIES_KEY) if isinstance(value, dict) else None
+        if overrides is None:
+            return value
+        if not isinstance(overrides, dict):
+            raise serializers.ValidationError(
+                f"{EXPORT_POLICIES_KEY} must map formats to export policies"
+            )
+        for file_format, policy in overrides.items():
+            if file_format not in DEFAULT_EXPORT_POLICIES:
+                raise serializers.ValidationError(
+                    f"Unknown format {file_format}, expected one of: "
+                    f"{', '.join(DEFAULT_EXPORT_POLICIES)}."
+                )
+            if policy not in EXPORT_POLICIES:
+                raise serializers.ValidationError(
+                    f"Unknown export policy {policy}, expected one of: "
+                    f"{', '.join(EXPORT_POLICIES)}."
+                )
+            fixed = file_format in FIXED_EXPORT_POLICY_FORMATS
+            if fixed and policy != DEFAULT_EXPORT_POLICIES[file_format]:
+                raise serializers.ValidationError(
+                    f"The export policy of {file_format} cannot be changed."
+                )
+        return value
+
 
 class PackageSetDetailedSerializer(PackageSetSerializer):
     integrations = IntegrationSerializer(
@@ -1,7 +1,10 @@
+from contextlib import contextmanager
+
 from celery import shared_task
+from django.db import connection
 
 from .serializers import PackageSerializer
-from .models import PackageSet
+from .models import GOOGLE_DRIVE_META_KEY, PackageSet, PackageSetTask
 
 
 @shared_task
@@ -11,3 +14,68 @@ def sync_gdrive_task(package_set_slug):
     serializer = PackageSerializer(new_packages, many=True)
     response = {"created": serializer.data, "total": len(new_packages)}
     return response
+
+
+def start_sync_gdrive_task(package_set: PackageSet) -> str:
+    """Queues an import of the new packages of a package set
+
+    Returns:
+        str -- the id of the task, see `is_sync_gdrive_task`
+    """
+    task = sync_gdrive_task.delay(package_set.slug)
+    # Kept in the database, so that its status can be polled from any web worker
+    PackageSetTask.objects.create(task_id=task.id, package_set=package_set)
+    return task.id
+
+
+def is_sync_gdrive_task(package_set: PackageSet, task_id: str) -> bool:
+    """Checks that a task is an import started for the package set"""
+    return PackageSetTask.objects.filter(
+        task_id=task_id, package_set=package_set
+    ).exists()
+
+
+@contextmanager
+def advisory_lock(name: str):
+    """Tries to take a Postgres advisory lock, shared by every worker using the database
+
+    The lock is held by the database session, and released on exit or if the worker
+    loses its connection.
+
+    Yields:
+        bool -- True if the lock was taken, False if it is held by another session
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(hashtext(%s))", [name])
+        acquired = cursor.fetchone()[0]
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(hashtext(%s))", [name])
+
+
+@shared_task
+def sync_gdrive_changes_task(package_set_slug):
+    # Skip the sync if the previous one for the package set is still running
+    with advisory_lock(f"sync-gdrive-changes:{package_set_slug}") as acquired:
+        if not acquired:
+            return None
+        package_set = PackageSet.objects.get(slug=package_set_slug)
+        created, refreshed = package_set.sync_gdrive_changes()
+    serializer = PackageSerializer(created, many=True)
+    response = {
+        "created": serializer.data,
+        "refreshed": [package.slug for package in refreshed],
+    }
+    return response
+
+
+@shared_task
+def sync_all_gdrive_changes_task():
+    """Queues a changes sync for every package set linked to a Google Drive folder"""
+    for package_set in PackageSet.objects.all():
+        gdrive_meta = (package_set.metadata or {}).get(GOOGLE_DRIVE_META_KEY) or {}
+        if gdrive_meta.get("folder_id"):
+            sync_gdrive_changes_task.delay(package_set.slug)
@@ -0,0 +1,23 @@
+import factory
+
+from kerckhoff.users.test.factories import UserFactory
+
+
+class PackageSetFactory(factory.django.DjangoModelFactory):
+
+    class Meta:
+        model = 'packages.PackageSet'
+        django_get_or_create = ('slug',)
+
+    slug = factory.Sequence(lambda n: f'packageset{n}')
+    created_by = factory.SubFactory(UserFactory)
+
+
+class PackageFactory(factory.django.DjangoModelFactory):
+
+    class Meta:
+        model = 'packages.Package'
+
+    slug = factory.Sequence(lambda n: f'package{n}')
+    package_set = factory.SubFactory(PackageSetFactory)
+    created_by = factory.SelfAttribute('package_set.created_by')
@@ -0,0 +1,40 @@
+import threading
+import time
+
+from django.test import SimpleTestCase
+from nose.tools import eq_, ok_
+
+from ..operations.concurrency import map_concurrently
+
+
+class TestMapConcurrently(SimpleTestCase):
+
+    def test_results_are_in_the_order_of_the_items(self):
+        def slow_square(n):
+            time.sleep(0.001 * (10 - n))
+            return n * n
+        eq_(map_concurrently(slow_square, range(10), 4), [n * n for n in range(10)])
+
+    def test_first_exception_is_raised(self):
+        def fail_on_three(n):
+            if n == 3:
+                raise ValueError(n)
+            return n
+        with self.assertRaises(ValueError):
+            map_concurrently(fail_on_three, range(10), 4)
+
+    def test_calls_not_started_are_cancelled_after_a_failure(self):
+        started = []
+        lock = threading.Lock()
+
+        def fail_first(n):
+            with lock:
+                started.append(n)
+            if n == 0:
+                raise ValueError(n)
+            time.sleep(0.05)
+            return n
+
+        with self.assertRaises(ValueError):
+            map_concurrently(fail_first, range(20), 2)
+        ok_(len(started) < 20)
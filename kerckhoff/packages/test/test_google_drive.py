@@ -0,0 +1,267 @@
+import json
+import re
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+from django.test import SimpleTestCase, override_settings
+from nose.tools import eq_, ok_
+
+from ..operations.google_drive import GoogleDriveOperations
+
+BOUNDARY = 'batch_response'
+
+
+def make_batch_response(request, items=None, throttled=()):
+    """Answers every request of a batch with the item, or a 404 for ids starting with 'missing'
+
+    Items are {'id': id} unless given in `items`, and the `throttled` ids are rate limited.
+    """
+    parts = []
+    for index, gdrive_id in enumerate(re.findall(r'GET /drive/v2/files/([^?\s]+)', request)):
+        if gdrive_id.startswith('missing'):
+            status, body = '404 Not Found', '{"error": {"code": 404}}'
+        elif gdrive_id in throttled:
+            status = '403 Forbidden'
+            body = '{"error": {"code": 403, "errors": [{"reason": "userRateLimitExceeded"}]}}'
+        else:
+            status, body = '200 OK', json.dumps((items or {}).get(gdrive_id, {'id': gdrive_id}))
+        parts.append(
+            f'--{BOUNDARY}\r\n'
+            'Content-Type: application/http\r\n'
+            f'Content-ID: <response-item-{index}>\r\n\r\n'
+            f'HTTP/1.1 {status}\r\n'
+            'Content-Type: application/json; charset=UTF-8\r\n\r\n'
+            f'{body}\r\n'
+        )
+    response = MagicMock(ok=True, headers={'Content-Type': f'multipart/mixed; boundary={BOUNDARY}'})
+    response.content = (''.join(parts) + f'--{BOUNDARY}--\r\n').encode('utf-8')
+    return response
+
+
+class TestFetchItemsMetadata(SimpleTestCase):
+
+    def setUp(self):
+        with patch.object(GoogleDriveOperations, '__init__', return_value=None):
+            self.ops = GoogleDriveOperations(None)
+        self.ops.rate_limiter = MagicMock()
+        self.ops.rate_limiter.acquire.return_value = 0
+        self.ops.oauth_session = MagicMock()
+        self.ops.oauth_session.request.side_effect = \
+            lambda method, url, data, headers: make_batch_response(data.decode('utf-8'))
+
+    def test_items_are_fetched_in_batches_of_100(self):
+        ids = [f'file{i}' for i in range(150)]
+        items = self.ops.fetch_items_metadata(ids)
+        eq_(self.ops.oauth_session.request.call_count, 2)
+        eq_(items, {gdrive_id: {'id': gdrive_id} for gdrive_id in ids})
+
+    def test_failed_items_are_none(self):
+        items = self.ops.fetch_items_metadata(['file', 'missing'])
+        eq_(items['file'], {'id': 'file'})
+        ok_(items['missing'] is None)
+
+    def test_only_the_file_fields_are_requested(self):
+        self.ops.fetch_items_metadata(['file'])
+        request = self.ops.oauth_session.request.call_args[1]['data'].decode('utf-8')
+        ok_('GET /drive/v2/files/file?fields=id%2Ctitle%2CmimeType' in request)
+
+    def test_non_ascii_items_are_decoded(self):
+        item = {'id': 'cafe', 'title': 'Café – Jalapeño.aml'}
+        self.ops.oauth_session.request.side_effect = lambda method, url, data, headers: \
+            make_batch_response(data.decode('utf-8'), items={'cafe': item})
+        eq_(self.ops.fetch_items_metadata(['cafe']), {'cafe': item})
+
+    @patch('kerckhoff.packages.operations.google_drive.time.sleep')
+    def test_rate_limited_parts_are_retried(self, sleep):
+        requests = []
+
+        def request(method, url, data, headers):
+            requests.append(re.findall(r'GET /drive/v2/files/([^?\s]+)', data.decode('utf-8')))
+            throttled = ('b', 'c') if len(requests) == 1 else ()
+            return make_batch_response(data.decode('utf-8'), throttled=throttled)
+
+        self.ops.oauth_session.request.side_effect = request
+        items = self.ops.fetch_items_metadata(['a', 'b', 'c'])
+        eq_(items, {gdrive_id: {'id': gdrive_id} for gdrive_id in 'abc'})
+        eq_(requests, [['a', 'b', 'c'], ['b', 'c']])
+        eq_(sleep.call_count, 1)
+        self.ops.rate_limiter.pause.assert_called_once()
+
+    @patch('kerckhoff.packages.operations.google_drive.time.sleep')
+    @override_settings(GOOGLE_OAUTH={'HTTP_MAX_RETRIES': 1, 'HTTP_RETRY_BACKOFF_FACTOR': 0.5})
+    def test_parts_rate_limited_on_every_attempt_are_none(self, sleep):
+        self.ops.oauth_session.request.side_effect = lambda method, url, data, headers: \
+            make_batch_response(data.decode('utf-8'), throttled=('b',))
+        eq_(self.ops.fetch_items_metadata(['a', 'b']), {'a': {'id': 'a'}, 'b': None})
+        eq_(self.ops.oauth_session.request.call_count, 2)
+
+    def test_every_part_takes_a_rate_limit_token(self):
+        with patch('kerckhoff.packages.operations.google_drive.record_quota_usage') as record_quota_usage:
+            self.ops.fetch_items_metadata([f'file{i}' for i in range(150)])
+        eq_([call[0] for call in self.ops.rate_limiter.acquire.call_args_list], [(100,), (50,)])
+        eq_(record_quota_usage.call_args_list[0][0], (0, False, 100))
+
+
+class TestDownloadItems(SimpleTestCase):
+
+    def setUp(self):
+        with patch.object(GoogleDriveOperations, '__init__', return_value=None):
+            self.ops = GoogleDriveOperations(None)
+        self.ops.rate_limiter = MagicMock()
+        self.ops.rate_limiter.acquire.return_value = 0
+        self.ops.oauth_session = MagicMock()
+        self.ops.oauth_session.request.side_effect = self.respond
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def respond(self, method, url, **kwargs):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.01)
+        with self.lock:
+            self.active -= 1
+        response = MagicMock(status_code=200, url=url)
+        response.__enter__.return_value = response
+        return response
+
+    def make_file(self, title):
+        def get_download_link(is_rich=False):
+            return f'https://drive/{title}?rich={is_rich}'
+
+        return MagicMock(title=title, get_download_link=get_download_link)
+
+    def test_responses_are_read_and_returned_in_order(self):
+        downloads = [(self.make_file(f'file{i}'), {'is_rich': i % 2 == 0}) for i in range(10)]
+        responses = self.ops.download_items(downloads, max_workers=4)
+        eq_([response.url for response in responses],
+            [f'https://drive/file{i}?rich={i % 2 == 0}' for i in range(10)])
+        ok_(1 < self.max_active <= 4)
+        for _, kwargs in self.ops.oauth_session.request.call_args_list:
+            eq_(kwargs, {'stream': True})
+
+    def test_responses_are_consumed_on_the_downloading_threads(self):
+        threads = set()
+
+        def consume(file, kwargs, response):
+            threads.add(threading.current_thread().name)
+            return (file.title, kwargs['is_rich'])
+
+        downloads = [(self.make_file(f'file{i}'), {'is_rich': True}) for i in range(6)]
+        eq_(self.ops.download_items(downloads, max_workers=3, consume=consume),
+            [(f'file{i}', True) for i in range(6)])
+        ok_(threading.current_thread().name not in threads)
+
+    @override_settings(PACKAGES={'MAX_CONCURRENT_DOWNLOADS': 1})
+    def test_downloads_are_bounded_by_the_setting(self):
+        self.ops.download_items([(self.make_file(f'file{i}'), {}) for i in range(3)])
+        eq_(self.max_active, 1)
+
+
+def make_json_response(body):
+    response = MagicMock(ok=True, status_code=200)
+    response.json.return_value = body
+    return response
+
+
+class TestFieldsProjection(SimpleTestCase):
+
+    def setUp(self):
+        with patch.object(GoogleDriveOperations, '__init__', return_value=None):
+            self.ops = GoogleDriveOperations(None)
+        self.ops.rate_limiter = MagicMock()
+        self.ops.rate_limiter.acquire.return_value = 0
+        self.ops.oauth_session = MagicMock()
+        self.params = []
+
+    def respond_with_pages(self, pages):
+        def request(method, url, params=None, **kwargs):
+            self.params.append(dict(params or {}))
+            return make_json_response(pages[len(self.params) - 1])
+        self.ops.oauth_session.request.side_effect = request
+
+    def test_listings_request_only_the_file_fields_on_every_page(self):
+        self.respond_with_pages([
+            {'items': [{'id': 'a'}], 'nextPageToken': 'page-2'},
+            {'items': [{'id': 'b'}]},
+        ])
+        items, next_token = self.ops.list_folder('folder')
+        eq_(items, [{'id': 'a'}, {'id': 'b'}])
+        ok_(next_token is None)
+        eq_([params.get('pageToken') for params in self.params], [None, 'page-2'])
+        for params in self.params:
+            eq_(params['fields'], f'nextPageToken,items({GoogleDriveOperations.FILE_FIELDS})')
+            eq_(params['maxResults'], 1000)
+
+    def test_full_resources_are_listed_without_fields(self):
+        self.respond_with_pages([{'items': []}])
+        self.ops.list_folder('folder', fields=None)
+        ok_('fields' not in self.params[0])
+
+    def test_changes_feed_is_paged_with_the_change_fields(self):
+        self.respond_with_pages([
+            {'items': [{'fileId': 'a'}], 'nextPageToken': 'page-2'},
+            {'items': [{'fileId': 'b'}], 'newStartPageToken': 'next-sync'},
+        ])
+        changes, start_token = self.ops.list_changes('start')
+        eq_(changes, [{'fileId': 'a'}, {'fileId': 'b'}])
+        eq_(start_token, 'next-sync')
+        eq_([params['pageToken'] for params in self.params], ['start', 'page-2'])
+        eq_(self.params[0]['fields'],
+            'nextPageToken,newStartPageToken,items(fileId,deleted,file(id,mimeType,parents/id))')
+
+    def test_single_items_are_fetched_with_the_file_fields(self):
+        self.respond_with_pages([{'id': 'a'}])
+        self.ops._fetch_item_metadata('a')
+        eq_(self.params, [{'fields': GoogleDriveOperations.FILE_FIELDS}])
+
+
+class TestServerSideFilters(SimpleTestCase):
+    FilterMethod = GoogleDriveOperations.FilterMethod
+    ItemFilter = GoogleDriveOperations.ItemFilter
+
+    def setUp(self):
+        with patch.object(GoogleDriveOperations, '__init__', return_value=None):
+            self.ops = GoogleDriveOperations(None)
+        self.ops.rate_limiter = MagicMock()
+        self.ops.rate_limiter.acquire.return_value = 0
+        self.ops.oauth_session = MagicMock()
+        self.ops.oauth_session.request.return_value = make_json_response({'items': [
+            {'id': '1', 'title': 'article.aml', 'mimeType': 'application/vnd.google-apps.document'},
+            {'id': '2', 'title': 'Notes', 'mimeType': 'application/vnd.google-apps.document'},
+            {'id': '3', 'title': 'photo.jpg', 'mimeType': 'image/jpeg'},
+        ]})
+
+    def test_filter_queries(self):
+        eq_(GoogleDriveOperations._get_filter_query(self.ItemFilter(self.FilterMethod.FOLDER)),
+            "mimeType = 'application/vnd.google-apps.folder'")
+        eq_(GoogleDriveOperations._get_filter_query(self.ItemFilter(self.FilterMethod.DOCUMENT)),
+            "mimeType = 'application/vnd.google-apps.document'")
+        eq_(GoogleDriveOperations._get_filter_query(self.ItemFilter(self.FilterMethod.IMAGES)),
+            "mimeType contains 'image/'")
+        eq_(GoogleDriveOperations._get_filter_query(self.ItemFilter(self.FilterMethod.EXTENSION, ('aml',))),
+            "mimeType != 'application/vnd.google-apps.folder'")
+
+    def test_filters_are_combined_in_the_listing_query(self):
+        self.ops.list_folder('folder', filters=[
+            self.ItemFilter(self.FilterMethod.IMAGES),
+            self.ItemFilter(self.FilterMethod.FOLDER),
+        ])
+        eq_(self.ops.oauth_session.request.call_args[1]['params']['q'],
+            "'folder' in parents and trashed=false and (mimeType contains 'image/' or "
+            "mimeType = 'application/vnd.google-apps.folder')")
+
+    def test_unfiltered_listings_only_exclude_trashed_items(self):
+        items, _ = self.ops.list_folder('folder')
+        query = self.ops.oauth_session.request.call_args[1]['params']['q']
+        eq_(query, "'folder' in parents and trashed=false")
+        eq_(len(items), 3)
+
+    def test_extensions_are_matched_client_side(self):
+        items, _ = self.ops.list_folder('folder', filters=[
+            self.ItemFilter(self.FilterMethod.IMAGES),
+            self.ItemFilter(self.FilterMethod.EXTENSION, ('aml', 'md')),
+        ])
+        eq_([item['id'] for item in items], ['1', '3'])
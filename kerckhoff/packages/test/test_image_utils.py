@@ -0,0 +1,173 @@
+import io
+import json
+from unittest.mock import MagicMock, patch
+
+from PIL import Image
+from django.test import SimpleTestCase, override_settings
+from nose.tools import eq_, ok_
+
+from ..operations import image_utils
+from ..operations.image_utils import ImageUtils, SpooledBuffer
+from ..operations.models import GoogleDriveImageFile
+
+DERIVATIVE_WIDTHS = {'medium': 100, 'thumbnail': 40}
+
+
+def make_image_file(md5_checksum='abc'):
+    return GoogleDriveImageFile({
+        'id': 'drive-photo',
+        'alternateLink': 'https://drive.google.com/file/d/photo',
+        'modifiedDate': '2019-05-26T20:06:00.000Z',
+        'lastModifyingUser': {'displayName': 'Joe Bruin'},
+        'title': 'photo.jpg',
+        'mimeType': 'image/jpeg',
+        'selfLink': 'https://www.googleapis.com/drive/v2/files/photo',
+        'thumbnailLink': 'https://lh3.googleusercontent.com/photo',
+        'md5Checksum': md5_checksum,
+    })
+
+
+def make_jpeg(width, height):
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), 'red').save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+SNAPSHOT_SETTINGS = {
+    'IMAGE_DERIVATIVES': DERIVATIVE_WIDTHS,
+    'IMAGE_WEBP_DERIVATIVES': False,
+    'IMAGE_QUALITY': 95,
+}
+
+
+@override_settings(PACKAGES=SNAPSHOT_SETTINGS)
+class TestSnapshotImage(SimpleTestCase):
+
+    def snapshot(self, existing_metadata=None, image_width=200):
+        response = MagicMock(ok=True)
+        response.iter_content.return_value = [make_jpeg(image_width, 100)]
+        drive_ops = MagicMock()
+        drive_ops.download_item.return_value = response
+        uploaded = {}
+
+        def upload_fileobj(s3, file_obj, bucket, mimetype, key=None, metadata=None):
+            uploaded[key] = metadata
+            return key, {}
+
+        with patch.object(image_utils, 'get_s3_client'), \
+                patch.object(image_utils, 'get_bucket_region', return_value='us-west-2'), \
+                patch.object(image_utils, 'get_object_metadata', return_value=existing_metadata), \
+                patch.object(image_utils, 'upload_fileobj', side_effect=upload_fileobj):
+            result = ImageUtils(None, drive_ops=drive_ops).snapshot_image(make_image_file(), bucket='media')
+        return result, uploaded
+
+    def test_derivative_keys_include_their_width(self):
+        result, uploaded = self.snapshot()
+        eq_(sorted(uploaded), ['abc-q95-medium-w100.jpg', 'abc-q95-thumbnail-w40.jpg', 'abc-q95.jpg'])
+        eq_(result['derivatives']['medium']['key'], 'abc-q95-medium-w100.jpg')
+        eq_(json.loads(uploaded['abc-q95.jpg']['derivatives']), result['derivatives'])
+
+    def test_small_images_record_the_configured_width(self):
+        result, _ = self.snapshot(image_width=60)
+        eq_(result['derivatives']['medium']['width'], 60)
+        eq_(result['derivatives']['medium']['max_width'], 100)
+
+    def test_existing_snapshot_with_the_same_derivatives_is_reused(self):
+        derivatives, _ = self.snapshot()
+        result, uploaded = self.snapshot({'derivatives': json.dumps(derivatives['derivatives'])})
+        eq_(uploaded, {})
+        eq_(result['key'], 'abc-q95.jpg')
+        eq_(result['derivatives'], derivatives['derivatives'])
+
+    def test_existing_snapshot_with_other_widths_is_replaced(self):
+        derivatives = {
+            'medium': {'key': 'abc-q95-medium-w80.jpg', 'width': 80, 'height': 40, 'max_width': 80},
+            'thumbnail': {'key': 'abc-q95-thumbnail-w40.jpg', 'width': 40, 'height': 20, 'max_width': 40},
+        }
+        result, uploaded = self.snapshot({'derivatives': json.dumps(derivatives)})
+        ok_('abc-q95-medium-w100.jpg' in uploaded)
+        eq_(result['derivatives']['medium']['max_width'], 100)
+
+
+class TestDerivativesMatch(SimpleTestCase):
+
+    def make_derivatives(self, widths, with_webp=False):
+        derivatives = {name: {'key': f'{name}.jpg', 'max_width': width} for name, width in widths.items()}
+        if with_webp:
+            for name, derivative in derivatives.items():
+                derivative['webp_key'] = f'{name}.webp'
+        return derivatives
+
+    def test_same_names_widths_and_formats_match(self):
+        ok_(ImageUtils._derivatives_match(self.make_derivatives(DERIVATIVE_WIDTHS), DERIVATIVE_WIDTHS, False))
+        ok_(ImageUtils._derivatives_match(
+            self.make_derivatives(DERIVATIVE_WIDTHS, with_webp=True), DERIVATIVE_WIDTHS, True
+        ))
+
+    def test_changed_width_does_not_match(self):
+        derivatives = self.make_derivatives({'medium': 120, 'thumbnail': 40})
+        ok_(not ImageUtils._derivatives_match(derivatives, DERIVATIVE_WIDTHS, False))
+
+    def test_missing_width_does_not_match(self):
+        derivatives = {
+            name: {'key': f'{name}.jpg', 'width': width} for name, width in DERIVATIVE_WIDTHS.items()
+        }
+        ok_(not ImageUtils._derivatives_match(derivatives, DERIVATIVE_WIDTHS, False))
+
+    def test_changed_names_or_formats_do_not_match(self):
+        renamed = self.make_derivatives({'medium': 100})
+        ok_(not ImageUtils._derivatives_match(renamed, DERIVATIVE_WIDTHS, False))
+        without_webp = self.make_derivatives(DERIVATIVE_WIDTHS)
+        ok_(not ImageUtils._derivatives_match(without_webp, DERIVATIVE_WIDTHS, True))
+
+
+class TestSpooledBuffer(SimpleTestCase):
+
+    def test_images_are_encoded_in_memory(self):
+        image = Image.new('RGB', (64, 64), 'red')
+        for image_format in ('JPEG', 'PNG', 'WEBP'):
+            with SpooledBuffer(max_size=1024 * 1024) as buffer:
+                ImageUtils(None)._compress_image(image, buffer, image_format)
+                ok_(not buffer._rolled, image_format)
+                buffer.seek(0)
+                with Image.open(buffer) as encoded:
+                    eq_(encoded.format, image_format)
+
+    def test_uploaded_images_are_not_rolled_over(self):
+        rolled = []
+
+        def upload_fileobj(s3, file_obj, bucket, mimetype, key=None, metadata=None):
+            rolled.append(file_obj._rolled)
+            return key, {}
+
+        with patch.object(image_utils, 'upload_fileobj', side_effect=upload_fileobj):
+            ImageUtils(None)._upload_image(
+                None, Image.new('RGB', (64, 64), 'red'), 'media', 'a.jpg', 'JPEG', 'image/jpeg', 95
+            )
+        eq_(rolled, [False])
+
+    def test_large_images_roll_over_to_disk(self):
+        with SpooledBuffer(max_size=16) as buffer:
+            ImageUtils(None)._compress_image(Image.new('RGB', (64, 64), 'red'), buffer, 'JPEG')
+            ok_(buffer._rolled)
+            ok_(buffer.fileno() >= 0)
+
+
+class TestImageContentHash(SimpleTestCase):
+
+    def get_content_hash(self, md5_checksum='abc', **packages):
+        with override_settings(PACKAGES=dict(SNAPSHOT_SETTINGS, **packages)):
+            return make_image_file(md5_checksum).get_content_hash()
+
+    def test_same_image_and_settings_have_the_same_hash(self):
+        eq_(self.get_content_hash(), self.get_content_hash())
+        ok_(self.get_content_hash() != self.get_content_hash('def'))
+
+    def test_snapshot_settings_change_the_hash(self):
+        content_hash = self.get_content_hash()
+        ok_(self.get_content_hash(IMAGE_DERIVATIVES={'medium': 120, 'thumbnail': 40}) != content_hash)
+        ok_(self.get_content_hash(IMAGE_WEBP_DERIVATIVES=True) != content_hash)
+        ok_(self.get_content_hash(IMAGE_QUALITY=80) != content_hash)
+
+    def test_images_without_checksum_have_no_hash(self):
+        ok_(self.get_content_hash(None) is None)
@@ -0,0 +1,366 @@
+from unittest.mock import MagicMock, patch
+
+from django.test import TestCase
+from nose.tools import eq_, ok_
+
+from .factories import PackageFactory, PackageSetFactory
+from ..models import (
+    EXPORT_POLICIES_KEY,
+    GOOGLE_DRIVE_CHANGES_TOKEN_KEY,
+    GOOGLE_DRIVE_META_KEY,
+    Package,
+    PackageVersion,
+)
+from ..operations.google_drive import GoogleDriveOperations
+from ..operations.models import (
+    EXPORT_PLAIN,
+    EXPORT_RICH,
+    FORMAT_AML,
+    FORMAT_MD,
+    FORMAT_PLAIN,
+    GoogleDriveTextFile,
+)
+
+
+def make_text_file(title, raw, modified_date="2019-05-26T20:06:00.000Z", drive_id=None):
+    text_file = GoogleDriveTextFile({
+        'id': drive_id or f'drive-{title}',
+        'alternateLink': f'https://docs.google.com/document/d/{title}',
+        'modifiedDate': modified_date,
+        'lastModifyingUser': {'displayName': 'Joe Bruin'},
+        'title': title,
+        'mimeType': 'application/vnd.google-apps.document',
+        'selfLink': f'https://www.googleapis.com/drive/v2/files/{title}',
+    })
+    text_file.parse_content(raw, is_rich=False)
+    return text_file.to_json()
+
+
+def make_folder(title):
+    return {
+        'id': f'folder-{title}',
+        'title': title,
+        'alternateLink': f'https://drive.google.com/drive/folders/{title}',
+        'mimeType': GoogleDriveOperations._GOOGLE_FOLDERS_MIMETYPE,
+    }
+
+
+class TestPackageSetGetNewPackages(TestCase):
+
+    def setUp(self):
+        self.package_set = PackageSetFactory(
+            metadata={GOOGLE_DRIVE_META_KEY: {'folder_id': 'root', 'folder_url': ''}}
+        )
+        PackageFactory(package_set=self.package_set, slug='existing')
+
+    def get_new_packages(self, folders):
+        with patch.object(GoogleDriveOperations, '__init__', return_value=None), \
+                patch.object(GoogleDriveOperations, 'list_folder', return_value=(folders, None)):
+            return self.package_set.get_new_packages_from_gdrive()
+
+    def test_only_missing_packages_are_created(self):
+        created = self.get_new_packages(
+            [make_folder('existing'), make_folder('new-a'), make_folder('new-a'), make_folder('new-b')]
+        )
+        eq_(sorted(package.slug for package in created), ['new-a', 'new-b'])
+        eq_(Package.objects.filter(package_set=self.package_set).count(), 3)
+        eq_(
+            Package.objects.get(slug='new-a').metadata[GOOGLE_DRIVE_META_KEY]['folder_id'],
+            'folder-new-a',
+        )
+
+    def test_nothing_is_created_when_up_to_date(self):
+        eq_(self.get_new_packages([make_folder('existing')]), [])
+
+
+def make_change(file_id, parent_ids=(), mime_type='text/plain'):
+    return {
+        'fileId': file_id,
+        'file': {
+            'id': file_id,
+            'mimeType': mime_type,
+            'parents': [{'id': parent_id} for parent_id in parent_ids],
+        },
+    }
+
+
+class TestPackageSetSyncGdriveChanges(TestCase):
+
+    def setUp(self):
+        self.package_set = PackageSetFactory(
+            metadata={GOOGLE_DRIVE_META_KEY: {'folder_id': 'root', 'folder_url': ''}}
+        )
+        self.package = PackageFactory(
+            package_set=self.package_set,
+            slug='existing',
+            metadata={GOOGLE_DRIVE_META_KEY: {'folder_id': 'folder-existing', 'folder_url': ''}},
+            cached=[make_text_file('article.aml', 'headline: Hello')],
+        )
+        self.other_package = PackageFactory(
+            package_set=self.package_set,
+            slug='other',
+            metadata={GOOGLE_DRIVE_META_KEY: {'folder_id': 'folder-other', 'folder_url': ''}},
+        )
+
+    def sync(self, changes=(), folders=()):
+        with patch.object(GoogleDriveOperations, '__init__', return_value=None), \
+                patch.object(GoogleDriveOperations, 'get_start_page_token', return_value='start'), \
+                patch.object(GoogleDriveOperations, 'list_changes', return_value=(list(changes), 'next')), \
+                patch.object(GoogleDriveOperations, 'list_folder', return_value=(list(folders), None)), \
+                patch.object(Package, 'fetch_cache') as fetch_cache:
+            created, refreshed = self.package_set.sync_gdrive_changes()
+        return created, refreshed, fetch_cache
+
+    def test_first_sync_imports_packages_and_records_token(self):
+        created, refreshed, _ = self.sync(folders=[make_folder('new')])
+        eq_([package.slug for package in created], ['new'])
+        eq_(refreshed, [])
+        eq_(self.package_set.metadata[GOOGLE_DRIVE_CHANGES_TOKEN_KEY], 'start')
+
+    def test_only_changed_packages_are_refreshed(self):
+        self.package_set.metadata[GOOGLE_DRIVE_CHANGES_TOKEN_KEY] = 'start'
+        self.package_set.save()
+        created, refreshed, fetch_cache = self.sync(changes=[
+            make_change('new-file', ['folder-existing']),
+            make_change('unrelated', ['elsewhere']),
+        ])
+        eq_(created, [])
+        eq_([package.slug for package in refreshed], ['existing'])
+        eq_(fetch_cache.call_count, 1)
+        eq_(self.package_set.metadata[GOOGLE_DRIVE_CHANGES_TOKEN_KEY], 'next')
+
+    def test_removed_files_refresh_their_package(self):
+        self.package_set.metadata[GOOGLE_DRIVE_CHANGES_TOKEN_KEY] = 'start'
+        self.package_set.save()
+        _, refreshed, _ = self.sync(changes=[{'fileId': 'drive-article.aml', 'deleted': True}])
+        eq_([package.slug for package in refreshed], ['existing'])
+
+    def test_removed_files_only_refresh_the_package_caching_them(self):
+        self.other_package.cached = [make_text_file('notes.txt', 'Notes')]
+        self.other_package.save()
+        self.package_set.metadata[GOOGLE_DRIVE_CHANGES_TOKEN_KEY] = 'start'
+        self.package_set.save()
+        _, refreshed, fetch_cache = self.sync(changes=[
+            {'fileId': 'drive-notes.txt', 'deleted': True},
+            {'fileId': 'drive-unknown', 'deleted': True},
+        ])
+        eq_([package.slug for package in refreshed], ['other'])
+        eq_(fetch_cache.call_count, 1)
+
+    def test_changed_folders_and_many_files_are_looked_up(self):
+        self.package_set.metadata[GOOGLE_DRIVE_CHANGES_TOKEN_KEY] = 'start'
+        self.package_set.save()
+        changes = [make_change(f'file-{i}', ['elsewhere']) for i in range(250)]
+        changes.append(make_change('drive-article.aml', ['elsewhere']))
+        changes.append(make_change('folder', ['elsewhere'], GoogleDriveOperations._GOOGLE_FOLDERS_MIMETYPE))
+        _, refreshed, _ = self.sync(changes=changes)
+        eq_([package.slug for package in refreshed], ['existing'])
+
+    def test_new_folders_are_imported(self):
+        self.package_set.metadata[GOOGLE_DRIVE_CHANGES_TOKEN_KEY] = 'start'
+        self.package_set.save()
+        created, _, _ = self.sync(
+            changes=[make_change('folder-new', ['root'], GoogleDriveOperations._GOOGLE_FOLDERS_MIMETYPE)],
+            folders=[make_folder('existing'), make_folder('new')],
+        )
+        eq_([package.slug for package in created], ['new'])
+
+
+class TestPackageCreateVersion(TestCase):
+
+    def setUp(self):
+        self.package = PackageFactory()
+        self.user = self.package.created_by
+        self.package.cached = [
+            make_text_file('article.aml', 'headline: Hello'),
+            make_text_file('notes.txt', 'Some notes'),
+        ]
+        self.package.save()
+
+    def create_version(self, titles):
+        return self.package.create_version(
+            self.user, PackageVersion(title='v', version_description='v'), titles
+        )
+
+    def test_create_version_links_all_items(self):
+        version = self.create_version(['article.aml', 'notes.txt'])
+        eq_(version.id_num, 1)
+        eq_(
+            sorted(version.packageitem_set.values_list('file_name', flat=True)),
+            ['article.aml', 'notes.txt'],
+        )
+        ok_(all(version.packageitem_set.values_list('content_hash', flat=True)))
+
+    def test_unchanged_items_are_reused(self):
+        first = self.create_version(['article.aml', 'notes.txt'])
+        second = self.create_version(['article.aml'])
+        eq_(second.id_num, 2)
+        eq_(
+            set(first.packageitem_set.values_list('id', flat=True)),
+            set(second.packageitem_set.values_list('id', flat=True)),
+        )
+
+    def test_changed_items_are_snapshotted_again(self):
+        first = self.create_version(['article.aml', 'notes.txt'])
+        self.package.cached[0] = make_text_file('article.aml', 'headline: Updated')
+        self.package.save()
+        second = self.create_version(['article.aml'])
+
+        old_article = first.packageitem_set.get(file_name='article.aml')
+        new_article = second.packageitem_set.get(file_name='article.aml')
+        ok_(old_article.id != new_article.id)
+        eq_(new_article.data['content_plain']['data'], {'headline': 'Updated'})
+        eq_(
+            first.packageitem_set.get(file_name='notes.txt').id,
+            second.packageitem_set.get(file_name='notes.txt').id,
+        )
+
+    def test_items_with_the_same_title_are_all_kept(self):
+        self.package.cached.append(make_text_file('notes.txt', 'Other notes', drive_id='drive-other'))
+        self.package.save()
+        first = self.create_version(['article.aml', 'notes.txt'])
+        first_notes = set(first.packageitem_set.filter(file_name='notes.txt').values_list('id', flat=True))
+        eq_(len(first_notes), 2)
+
+        # Not updated, both are carried over
+        second = self.create_version(['article.aml'])
+        second_notes = second.packageitem_set.filter(file_name='notes.txt').values_list('id', flat=True)
+        eq_(set(second_notes), first_notes)
+
+        # Updated with the same content, both are reused
+        third = self.create_version(['notes.txt'])
+        third_notes = third.packageitem_set.filter(file_name='notes.txt').values_list('id', flat=True)
+        eq_(set(third_notes), first_notes)
+        eq_(third.packageitem_set.count(), 3)
+
+
+def make_drive_document(title, modified_date='2019-05-26T20:06:00.000Z', md5_checksum=None):
+    document = {
+        'id': f'drive-{title}',
+        'alternateLink': f'https://docs.google.com/document/d/{title}',
+        'modifiedDate': modified_date,
+        'lastModifyingUser': {'displayName': 'Joe Bruin'},
+        'title': title,
+        'mimeType': 'application/vnd.google-apps.document',
+        'selfLink': f'https://www.googleapis.com/drive/v2/files/{title}',
+    }
+    if md5_checksum:
+        document['md5Checksum'] = md5_checksum
+    return document
+
+
+def make_export_response(text):
+    response = MagicMock(text=text, content=text.encode('utf-8'))
+    response.iter_content.return_value = [text.encode('utf-8')]
+    return response
+
+
+class TestPackageFetchCacheExportPolicies(TestCase):
+    exports = {
+        ('article.aml', False): 'headline: Hello',
+        ('article.aml', True): '<p>headline: <span style="font-weight:700">Hello</span></p>',
+        ('notes.txt', False): 'Fish &amp; chips',
+        ('notes.txt', True): '<p><span style="font-weight:400">Fish &amp; chips</span></p>',
+    }
+
+    def setUp(self):
+        self.package = PackageFactory()
+
+    def fetch_cache(self):
+        downloaded = []
+
+        def download_items(downloads, consume=None):
+            downloaded.extend((file.title, kwargs['is_rich']) for file, kwargs in downloads)
+            return [
+                consume(file, kwargs, make_export_response(self.exports[(file.title, kwargs['is_rich'])]))
+                for file, kwargs in downloads
+            ]
+
+        items = [make_drive_document('article.aml'), make_drive_document('notes.txt')]
+        with patch.object(GoogleDriveOperations, '__init__', return_value=None), \
+                patch.object(GoogleDriveOperations, 'list_folder', return_value=(items, None)), \
+                patch.object(GoogleDriveOperations, 'download_items', side_effect=download_items):
+            self.package.fetch_cache()
+        return sorted(downloaded), {item['title']: item for item in self.package.cached}
+
+    def test_default_policies(self):
+        downloaded, cached = self.fetch_cache()
+        eq_(downloaded, [('article.aml', False), ('article.aml', True), ('notes.txt', True)])
+        eq_(cached['article.aml']['content_plain']['data'], {'headline': 'Hello'})
+        eq_(
+            cached['article.aml']['content_rich']['data'],
+            {'headline': '<span style="font-weight:700;">Hello</span>'},
+        )
+        eq_(cached['notes.txt']['content_rich']['raw'], 'Fish &amp; chips\n')
+        eq_(cached['notes.txt']['content_plain']['raw'], 'Fish & chips\n')
+
+    def test_package_set_overrides_the_default_policies(self):
+        self.package.package_set.metadata[EXPORT_POLICIES_KEY] = {FORMAT_AML: EXPORT_PLAIN}
+        self.package.package_set.save()
+        downloaded, cached = self.fetch_cache()
+        eq_(downloaded, [('article.aml', False), ('notes.txt', True)])
+        eq_(cached['article.aml']['content_plain']['data'], {'headline': 'Hello'})
+        ok_('content_rich' not in cached['article.aml'])
+
+    def test_invalid_and_fixed_policies_are_ignored(self):
+        self.package.package_set.metadata[EXPORT_POLICIES_KEY] = {
+            FORMAT_MD: EXPORT_RICH,
+            FORMAT_PLAIN: 'everything',
+            FORMAT_AML: EXPORT_RICH,
+        }
+        eq_(
+            self.package.package_set.get_export_policies(),
+            {FORMAT_AML: EXPORT_RICH, FORMAT_MD: EXPORT_PLAIN, FORMAT_PLAIN: EXPORT_RICH},
+        )
+
+
+class TestPackageFetchCacheIncremental(TestCase):
+
+    def setUp(self):
+        self.package = PackageFactory()
+        self.exports = {'article.aml': 'headline: Hello', 'notes.txt': 'Notes'}
+
+    def fetch_cache(self, items, incremental=True):
+        downloaded = []
+
+        def download_items(downloads, consume=None):
+            downloaded.extend(file.title for file, _ in downloads)
+            return [consume(file, kwargs, make_export_response(self.exports[file.title]))
+                    for file, kwargs in downloads]
+
+        with patch.object(GoogleDriveOperations, '__init__', return_value=None), \
+                patch.object(GoogleDriveOperations, 'list_folder', return_value=(items, None)), \
+                patch.object(GoogleDriveOperations, 'download_items', side_effect=download_items):
+            self.package.fetch_cache(incremental=incremental)
+        return sorted(downloaded), {item['title']: item for item in self.package.cached}
+
+    def test_unchanged_files_are_not_downloaded_again(self):
+        items = [make_drive_document('article.aml'), make_drive_document('notes.txt', md5_checksum='a')]
+        eq_(self.fetch_cache(items)[0], ['article.aml', 'article.aml', 'notes.txt'])
+        self.exports['article.aml'] = 'headline: Changed'
+        downloaded, cached = self.fetch_cache(items)
+        eq_(downloaded, [])
+        eq_(cached['article.aml']['content_plain']['data'], {'headline': 'Hello'})
+        eq_(cached['notes.txt']['content_plain']['raw'], 'Notes')
+
+    def test_files_with_a_new_modified_date_are_downloaded_again(self):
+        self.fetch_cache([make_drive_document('article.aml'), make_drive_document('notes.txt')])
+        self.exports['article.aml'] = 'headline: Changed'
+        downloaded, cached = self.fetch_cache([
+            make_drive_document('article.aml', modified_date='2019-05-27T20:06:00.000Z'),
+            make_drive_document('notes.txt'),
+        ])
+        eq_(downloaded, ['article.aml', 'article.aml'])
+        eq_(cached['article.aml']['content_plain']['data'], {'headline': 'Changed'})
+
+    def test_files_with_a_new_checksum_are_downloaded_again(self):
+        self.fetch_cache([make_drive_document('notes.txt', md5_checksum='a')])
+        self.exports['notes.txt'] = 'New notes'
+        downloaded, cached = self.fetch_cache([make_drive_document('notes.txt', md5_checksum='b')])
+        eq_(downloaded, ['notes.txt'])
+        eq_(cached['notes.txt']['content_plain']['raw'], 'New notes')
+
+    def test_full_fetch_downloads_every_file(self):
+        items = [make_drive_document('article.aml'), make_drive_document('notes.txt')]
+        self.fetch_cache(items)
+        eq_(self.fetch_cache(items, incremental=False)[0], ['article.aml', 'article.aml', 'notes.txt'])
@@ -0,0 +1,139 @@
+import io
+from unittest.mock import patch
+
+import archieml
+from django.core.cache import cache
+from django.test import SimpleTestCase
+from nose.tools import eq_
+
+from ..operations.models import FORMAT_AML, ParsedContent
+from ..operations.parser import Parser
+from ..operations.utils import decode_chunks
+
+# Documents parsed the same way by Parser and the archieml reference implementation
+PARITY_DOCUMENTS = {
+    'pairs': 'headline: Hello world\nauthor: Joe Bruin\n',
+    'comments': 'This is a comment\nkey: value\nMore comments\n',
+    'dotted_keys': 'colors.red: #f00\ncolors.green: #0f0\n',
+    'multiline': 'key: value\nmore value\n:end\n',
+    'multiline_escape': 'key: value\n\\:end\nmore\n:end\n',
+    'block': '{colors}\nred: #f00\n{}\nother: x\n',
+    'nested_block': '{colors.reds}\ncrimson: #dc143c\n{}\n',
+    'string_array': '[tags]\n* news\n* sports\n[]\n',
+    'object_array': '[authors]\nname: Joe\nrole: writer\nname: Jane\nrole: editor\n[]\n',
+    'nested_array': '[stories]\ntitle: A\n[.tags]\n* x\n* y\n[]\ntitle: B\n[]\n',
+    'freeform_array': '[+body]\nFirst paragraph.\nimage: a.png\nSecond paragraph.\n[]\n',
+    'freeform_block': '[+body]\n{.image}\nsrc: a.png\n{}\ntext\n[]\n',
+    'freeform_nested_array': '[+body]\n[.list]\n* x\n[]\n[]\n',
+    'skip': 'a: 1\n:skip\nb: 2\n:endskip\nc: 3\n',
+    'ignore': 'a: 1\n:ignore\nb: 2\n',
+    'case_insensitive_commands': 'a: 1\n:SKIP\nb: 2\n:EndSkip\nkey: v\nmore\n:END\n',
+    'invalid_keys': 'a key: no\n[bad: x\nok: yes\n',
+    'colons_in_value': 'url: http://example.com:8080/x\n',
+    'whitespace': '  key  :   value   \n',
+    'list_item_outside_array': 'a: 1\n* not a list\n',
+    'block_ends_array': '[list]\n* a\n{b}\nc: d\n',
+    'overwritten_key': 'a: 1\na: 2\n',
+    'consecutive_arrays': '[a]\n* 1\n[b]\n* 2\n[]\n',
+}
+
+
+class TestParserParity(SimpleTestCase):
+
+    def test_documents_match_reference_implementation(self):
+        for name, document in PARITY_DOCUMENTS.items():
+            with self.subTest(name):
+                eq_(Parser().parse(document), archieml.loads(document))
+
+    def test_nested_arrays_are_appended_to_their_item(self):
+        # archieml 0.3.4 attaches the second inner array to the wrong item
+        document = '[outer]\n[.inner]\nx: 1\n[]\n[.inner]\nx: 2\n[]\n[]\n'
+        eq_(
+            Parser().parse(document),
+            {'outer': [{'inner': [{'x': '1'}]}, {'inner': [{'x': '2'}]}]},
+        )
+
+    def test_deeply_nested_scopes(self):
+        document = (
+            '{guide.races}\n'
+            '[.candidates]\n'
+            'name: A\n'
+            '[.positions]\n'
+            'title: One\n'
+            '[.terms]\n'
+            '* 2018\n'
+            '* 2019\n'
+            '[]\n'
+            'title: Two\n'
+            '[]\n'
+            'name: B\n'
+            '[]\n'
+            '{}\n'
+            'footer: end\n'
+        )
+        eq_(
+            Parser().parse(document),
+            {
+                'guide': {'races': {'candidates': [
+                    {'name': 'A', 'positions': [
+                        {'title': 'One', 'terms': ['2018', '2019']},
+                        {'title': 'Two'},
+                    ]},
+                    {'name': 'B'},
+                ]}},
+                'footer': 'end',
+            },
+        )
+
+
+class TestParserStreaming(SimpleTestCase):
+
+    def setUp(self):
+        self.document = '\n'.join(PARITY_DOCUMENTS.values()) + 'title: Café\n:ignore\nrest: x'
+        self.expected = Parser().parse(self.document)
+
+    def test_chunks_of_any_size_are_parsed_like_the_whole_document(self):
+        encoded = self.document.encode('utf-8')
+        for size in (1, 2, 7, 64, len(encoded)):
+            with self.subTest(size):
+                chunks = [encoded[i:i + size] for i in range(0, len(encoded), size)]
+                eq_(Parser().parse_stream(decode_chunks(chunks)), self.expected)
+
+    def test_file_like_objects_and_lines_are_parsed(self):
+        eq_(Parser().parse(io.BytesIO(self.document.encode('utf-8-sig'))), self.expected)
+        eq_(Parser().parse(io.StringIO(self.document)), self.expected)
+        eq_(Parser().parse(self.document.split('\n')), self.expected)
+
+    def test_parsed_content_from_stream_keeps_all_of_the_raw_content(self):
+        chunks = [self.document[i:i + 10] for i in range(0, len(self.document), 10)]
+        content = ParsedContent.from_stream(chunks, FORMAT_AML)
+        eq_(content.raw, self.document)
+        eq_(content.data, self.expected)
+
+
+class TestParsedContentCache(SimpleTestCase):
+    document = 'headline: Hello world\n[tags]\n* news\n[]\n'
+
+    def setUp(self):
+        cache.clear()
+
+    def test_identical_content_is_parsed_once(self):
+        with patch.object(Parser, 'parse', autospec=True, side_effect=Parser.parse) as parse:
+            first = ParsedContent(self.document, FORMAT_AML)
+            second = ParsedContent(self.document.encode('utf-8'), FORMAT_AML)
+        eq_(parse.call_count, 1)
+        eq_(second.data, first.data)
+        eq_(second.raw, self.document)
+
+    def test_streamed_content_is_cached(self):
+        ParsedContent.from_stream([self.document], FORMAT_AML)
+        with patch.object(Parser, 'parse', autospec=True) as parse:
+            content = ParsedContent(self.document, FORMAT_AML)
+        eq_(parse.call_count, 0)
+        eq_(content.data, {'headline': 'Hello world', 'tags': ['news']})
+
+    def test_errors_are_not_cached(self):
+        with patch.object(Parser, 'parse', autospec=True, side_effect=ValueError('oops')):
+            content = ParsedContent(self.document, FORMAT_AML)
+        eq_(content.data, {'status': 1, 'content': {'Error': 'oops'}})
+        eq_(cache.get(ParsedContent.get_cache_key(self.document, FORMAT_AML)), None)
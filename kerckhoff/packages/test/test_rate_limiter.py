@@ -0,0 +1,59 @@
+from unittest.mock import MagicMock, patch
+
+from django.test import SimpleTestCase
+from nose.tools import eq_, ok_
+
+from ..operations.google_drive import GoogleDriveOperations
+from ..operations.rate_limiter import TokenBucket
+
+
+def make_response(status_code, headers=None, reason=None):
+    response = MagicMock(status_code=status_code, headers=headers or {})
+    response.json.return_value = {'error': {'errors': [{'reason': reason}]}}
+    return response
+
+
+class TestTokenBucket(SimpleTestCase):
+
+    def test_burst_is_allowed_up_to_capacity(self):
+        bucket = TokenBucket('test-burst', rate=1, capacity=3)
+        eq_([bucket._take(1, 0) for _ in range(3)], [0, 0, 0])
+        ok_(bucket._take(1, 0) > 0.9)
+
+    def test_tokens_beyond_the_capacity_are_taken_a_bucketful_at_a_time(self):
+        bucket = TokenBucket('test-many', rate=1000, capacity=3)
+        # The first 3 tokens are in the bucket, the other 4 are waited for
+        ok_(bucket.acquire(7) >= 0.004 * 0.9)
+        ok_(bucket._take(1, 0) > 0)
+
+    def test_pause_empties_the_bucket(self):
+        bucket = TokenBucket('test-pause', rate=10, capacity=10)
+        bucket.pause(2)
+        ok_(bucket._take(1, 0) > 2)
+
+
+class TestGoogleDriveRateLimiting(SimpleTestCase):
+
+    def setUp(self):
+        with patch.object(GoogleDriveOperations, '__init__', return_value=None):
+            self.ops = GoogleDriveOperations(None)
+        self.ops.rate_limiter = MagicMock()
+        self.ops.rate_limiter.acquire.return_value = 0
+        self.ops.oauth_session = MagicMock()
+
+    def test_rate_limit_responses_are_detected(self):
+        ok_(GoogleDriveOperations._is_rate_limited(make_response(429)))
+        ok_(GoogleDriveOperations._is_rate_limited(make_response(403, reason='userRateLimitExceeded')))
+        ok_(not GoogleDriveOperations._is_rate_limited(make_response(403, reason='insufficientPermissions')))
+        ok_(not GoogleDriveOperations._is_rate_limited(make_response(200)))
+
+    @patch('kerckhoff.packages.operations.google_drive.time.sleep')
+    def test_rate_limited_requests_are_retried_after_retry_after(self, sleep):
+        self.ops.oauth_session.request.side_effect = [
+            make_response(429, headers={'Retry-After': '30'}),
+            make_response(200),
+        ]
+        eq_(self.ops._request('GET', 'https://example.com').status_code, 200)
+        eq_(self.ops.oauth_session.request.call_count, 2)
+        ok_(sleep.call_args[0][0] >= 30)
+        eq_(self.ops.rate_limiter.pause.call_args, sleep.call_args)
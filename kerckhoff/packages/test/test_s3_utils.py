@@ -0,0 +1,117 @@
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+from botocore.exceptions import ClientError
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+from nose.tools import eq_, ok_
+
+from ..operations import s3_utils
+from ..operations.s3_utils import get_bucket_region, get_object_metadata, get_presigned_url
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestGetPresignedUrl(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.s3 = MagicMock()
+        self.s3.generate_presigned_url.side_effect = lambda *args, **kwargs: \
+            f'https://s3/{kwargs["Params"]["Key"]}?sig={self.s3.generate_presigned_url.call_count}'
+        patcher = patch.object(s3_utils, 'get_s3_client', return_value=self.s3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_urls_are_reused_while_cached(self):
+        first = get_presigned_url('media', 'a.jpg')
+        eq_(get_presigned_url('media', 'a.jpg'), first)
+        eq_(self.s3.generate_presigned_url.call_count, 1)
+        self.s3.generate_presigned_url.assert_called_with(
+            'get_object', Params={'Bucket': 'media', 'Key': 'a.jpg'}, ExpiresIn=3600
+        )
+
+    def test_urls_are_cached_per_object_and_duration(self):
+        get_presigned_url('media', 'a.jpg')
+        get_presigned_url('media', 'b.jpg')
+        get_presigned_url('media', 'a.jpg', duration=60)
+        eq_(self.s3.generate_presigned_url.call_count, 3)
+
+    def test_urls_are_signed_again_before_they_expire(self):
+        with patch('time.time', return_value=1000):
+            first = get_presigned_url('media', 'a.jpg')
+        # Still reused until PRESIGNED_URL_REUSE_RATIO of the validity has elapsed
+        with patch('time.time', return_value=1000 + 3600 * 0.8 - 1):
+            eq_(get_presigned_url('media', 'a.jpg'), first)
+        with patch('time.time', return_value=1000 + 3600 * 0.8 + 1):
+            second = get_presigned_url('media', 'a.jpg')
+        eq_(self.s3.generate_presigned_url.call_count, 2)
+        eq_(second, 'https://s3/a.jpg?sig=2')
+
+
+class TestGetBucketRegion(SimpleTestCase):
+
+    def setUp(self):
+        patcher = patch.dict(s3_utils._bucket_regions, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.s3 = MagicMock()
+        self.s3.get_bucket_location.return_value = {'LocationConstraint': 'us-west-2'}
+
+    @override_settings(AWS_CONFIG={'MEDIA_BUCKET_NAME': 'media'})
+    def test_region_is_looked_up_once_per_bucket(self):
+        eq_(get_bucket_region(self.s3, 'media'), 'us-west-2')
+        eq_(get_bucket_region(self.s3, 'media'), 'us-west-2')
+        eq_(get_bucket_region(self.s3, 'other'), 'us-west-2')
+        eq_(self.s3.get_bucket_location.call_count, 2)
+
+    @override_settings(AWS_CONFIG={'MEDIA_BUCKET_NAME': 'media', 'MEDIA_BUCKET_REGION': 'eu-west-1'})
+    def test_configured_region_is_not_looked_up(self):
+        eq_(get_bucket_region(self.s3, 'media'), 'eu-west-1')
+        eq_(self.s3.get_bucket_location.call_count, 0)
+
+    @override_settings(AWS_CONFIG={'MEDIA_BUCKET_NAME': 'media'})
+    def test_concurrent_lookups_share_a_single_request(self):
+        def get_bucket_location(Bucket):
+            time.sleep(0.01)
+            return {'LocationConstraint': 'us-west-2'}
+
+        self.s3.get_bucket_location.side_effect = get_bucket_location
+        regions = []
+        threads = [threading.Thread(target=lambda: regions.append(get_bucket_region(self.s3, 'media')))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_(regions, ['us-west-2'] * 8)
+        eq_(self.s3.get_bucket_location.call_count, 1)
+
+
+class TestGetObjectMetadata(SimpleTestCase):
+
+    def setUp(self):
+        self.s3 = MagicMock()
+
+    def head_object_fails(self, code):
+        self.s3.head_object.side_effect = ClientError({'Error': {'Code': code}}, 'HeadObject')
+
+    def test_metadata_is_returned(self):
+        self.s3.head_object.return_value = {'Metadata': {'content-hash': 'abc'}}
+        eq_(get_object_metadata(self.s3, 'media', 'a.jpg'), {'content-hash': 'abc'})
+
+    def test_missing_objects_return_none(self):
+        for code in ('404', 'NoSuchKey'):
+            self.head_object_fails(code)
+            ok_(get_object_metadata(self.s3, 'media', 'a.jpg') is None)
+
+    def test_forbidden_objects_are_treated_as_missing(self):
+        # S3 answers 403 for missing keys when the credentials lack s3:ListBucket
+        for code in ('403', 'AccessDenied'):
+            self.head_object_fails(code)
+            ok_(get_object_metadata(self.s3, 'media', 'a.jpg') is None)
+
+    def test_other_errors_are_raised(self):
+        self.head_object_fails('500')
+        with self.assertRaises(ClientError):
+            get_object_metadata(self.s3, 'media', 'a.jpg')
@@ -0,0 +1,49 @@
+from django.test import SimpleTestCase
+from nose.tools import eq_
+from rest_framework.exceptions import ValidationError
+
+from ..models import EXPORT_POLICIES_KEY
+from ..operations.models import (
+    EXPORT_BOTH, EXPORT_PLAIN, EXPORT_RICH, FORMAT_AML, FORMAT_MD, FORMAT_PLAIN
+)
+from ..serializers import PackageSetSerializer
+
+
+class TestPackageSetSerializerValidateMetadata(SimpleTestCase):
+
+    def validate(self, export_policies):
+        metadata = {'other': 'value', EXPORT_POLICIES_KEY: export_policies}
+        return PackageSetSerializer().validate_metadata(metadata)
+
+    def assert_invalid(self, export_policies, message):
+        with self.assertRaises(ValidationError) as context:
+            self.validate(export_policies)
+        eq_(context.exception.detail, [message])
+
+    def test_valid_overrides_are_accepted(self):
+        metadata = self.validate(
+            {FORMAT_AML: EXPORT_PLAIN, FORMAT_PLAIN: EXPORT_BOTH, FORMAT_MD: EXPORT_PLAIN}
+        )
+        eq_(metadata[EXPORT_POLICIES_KEY][FORMAT_AML], EXPORT_PLAIN)
+
+    def test_metadata_without_overrides_is_accepted(self):
+        eq_(PackageSetSerializer().validate_metadata({'other': 'value'}), {'other': 'value'})
+
+    def test_overrides_must_be_a_mapping(self):
+        self.assert_invalid(
+            [EXPORT_PLAIN], f'{EXPORT_POLICIES_KEY} must map formats to export policies'
+        )
+
+    def test_unknown_formats_are_rejected(self):
+        self.assert_invalid(
+            {'DOCX': EXPORT_PLAIN}, 'Unknown format DOCX, expected one of: AML, MD, PLAIN.'
+        )
+
+    def test_unknown_policies_are_rejected(self):
+        self.assert_invalid(
+            {FORMAT_AML: 'everything'},
+            'Unknown export policy everything, expected one of: plain, rich, both.',
+        )
+
+    def test_fixed_policies_cannot_be_changed(self):
+        self.assert_invalid({FORMAT_MD: EXPORT_RICH}, 'The export policy of MD cannot be changed.')
@@ -0,0 +1,47 @@
+from unittest.mock import patch
+
+from django.db import connection
+from django.test import TestCase
+from nose.tools import eq_, ok_
+
+from .factories import PackageSetFactory
+from ..models import PackageSet
+from ..tasks import advisory_lock, sync_gdrive_changes_task
+
+
+class TestSyncGdriveChangesTask(TestCase):
+
+    def setUp(self):
+        self.package_set = PackageSetFactory()
+        # Another worker, with its own database session
+        self.other_connection = connection.copy()
+        self.addCleanup(self.other_connection.close)
+
+    def sync(self):
+        with patch.object(PackageSet, 'sync_gdrive_changes', return_value=([], [])) as sync_gdrive_changes:
+            result = sync_gdrive_changes_task(self.package_set.slug)
+        return result, sync_gdrive_changes
+
+    def test_changes_are_synced(self):
+        result, sync_gdrive_changes = self.sync()
+        eq_(result, {'created': [], 'refreshed': []})
+        eq_(sync_gdrive_changes.call_count, 1)
+
+    def test_sync_is_skipped_while_another_worker_syncs_the_package_set(self):
+        lock_name = f'sync-gdrive-changes:{self.package_set.slug}'
+        with self.other_connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_lock(hashtext(%s))', [lock_name])
+        result, sync_gdrive_changes = self.sync()
+        ok_(result is None)
+        eq_(sync_gdrive_changes.call_count, 0)
+
+        with self.other_connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(hashtext(%s))', [lock_name])
+        eq_(self.sync()[1].call_count, 1)
+
+    def test_lock_is_released_after_a_failed_sync(self):
+        with patch.object(PackageSet, 'sync_gdrive_changes', side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                sync_gdrive_changes_task(self.package_set.slug)
+        with advisory_lock(f'sync-gdrive-changes:{self.package_set.slug}') as acquired:
+            ok_(acquired)
@@ -0,0 +1,49 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.test import SimpleTestCase
+from nose.tools import eq_, ok_
+
+from ..operations.utils import GoogleDocHTMLCleaner, MarkdownConverter, html_to_text
+
+
+class TestMarkdownConverter(SimpleTestCase):
+
+    def test_state_is_not_kept_between_documents(self):
+        converter = MarkdownConverter(extensions=['footnotes'])
+        first = converter.convert('Text[^1]\n\n[^1]: A footnote')
+        second = converter.convert('More text')
+        ok_('A footnote' in first)
+        eq_(second, '<p>More text</p>')
+
+    def test_each_thread_converts_with_its_own_instance(self):
+        converter = MarkdownConverter()
+        documents = ['# Title %d\n\nParagraph [link][%d]\n\n[%d]: /%d' % ((i,) * 4)
+                     for i in range(50)]
+        expected = [MarkdownConverter().convert(document) for document in documents]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            eq_(list(executor.map(converter.convert, documents)), expected)
+
+
+class TestGoogleDocHTMLCleaner(SimpleTestCase):
+
+    def test_only_interesting_styles_are_kept(self):
+        html = ('<p><span style="font-weight:700;color:#000000">Bold</span>'
+                '<span style="font-weight:400;font-style:normal">plain</span></p>')
+        eq_(GoogleDocHTMLCleaner.clean(html), '<span style="font-weight:700;">Bold</span>plain\n')
+
+    def test_spans_without_styles_are_unwrapped(self):
+        html = ('<p><span class="c1">a</span><span style="font-style:italic;text-decoration:none">'
+                'b</span></p><p>c</p>')
+        eq_(GoogleDocHTMLCleaner.clean(html), 'a<span style="font-style:italic;">b</span>\nc\n')
+
+    def test_google_redirects_are_removed_from_links(self):
+        html = ('<p><a href="https://www.google.com/url?q=https://dailybruin.com/x&amp;sa=D">link</a> '
+                '<a href="/keep">keep</a></p>')
+        eq_(GoogleDocHTMLCleaner.clean(html),
+            '<a href="https://dailybruin.com/x">link</a> <a href="/keep">keep</a>\n')
+
+    def test_cleaned_html_is_converted_to_text(self):
+        html = GoogleDocHTMLCleaner.clean(
+            '<p><span style="font-weight:700">Fish</span> &amp; chips</p><p>1 &lt; 2</p>'
+        )
+        eq_(html_to_text(html), 'Fish & chips\n1 < 2\n')
@@ -0,0 +1,70 @@
+from unittest.mock import MagicMock, patch
+
+from django.urls import reverse
+from nose.tools import eq_
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from kerckhoff.users.test.factories import UserFactory
+from .factories import PackageSetFactory
+from ..models import PackageSetTask
+from ..tasks import sync_gdrive_task
+
+
+class TestPackageSetSyncGdrive(APITestCase):
+
+    def setUp(self):
+        self.user = UserFactory()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.user.auth_token}')
+        self.package_set = PackageSetFactory()
+        self.other_package_set = PackageSetFactory()
+
+    def start_sync(self, package_set, task_id, url_name='packageset-sync-gdrive'):
+        url = reverse(url_name, kwargs={'slug': package_set.slug})
+        with patch.object(sync_gdrive_task, 'delay', return_value=MagicMock(id=task_id)) as delay:
+            response = self.client.post(url)
+        return response, delay
+
+    def get_status(self, package_set, task_id):
+        url = reverse(
+            'packageset-sync-gdrive-status',
+            kwargs={'slug': package_set.slug, 'task_id': task_id},
+        )
+        result = {'id': task_id, 'state': 'SUCCESS', 'result': {'created': [], 'total': 0}}
+        with patch('kerckhoff.packages.views.get_task_result', return_value=result):
+            return self.client.get(url)
+
+    def test_sync_is_started_in_the_background(self):
+        response, delay = self.start_sync(self.package_set, 'task-1')
+        eq_(response.status_code, status.HTTP_202_ACCEPTED)
+        eq_(response.data, {'id': 'task-1'})
+        delay.assert_called_once_with(self.package_set.slug)
+        eq_(PackageSetTask.objects.get(task_id='task-1').package_set, self.package_set)
+
+    def test_async_sync_is_kept_for_existing_clients(self):
+        response, delay = self.start_sync(self.package_set, 'task-1', 'packageset-async-sync-gdrive')
+        eq_(response.status_code, status.HTTP_200_OK)
+        eq_(response.data, {'id': 'task-1'})
+        delay.assert_called_once_with(self.package_set.slug)
+        eq_(self.get_status(self.package_set, 'task-1').status_code, status.HTTP_200_OK)
+
+    def test_sync_of_unknown_package_set_is_not_started(self):
+        url = reverse('packageset-sync-gdrive', kwargs={'slug': 'missing'})
+        with patch.object(sync_gdrive_task, 'delay') as delay:
+            response = self.client.post(url)
+        eq_(response.status_code, status.HTTP_404_NOT_FOUND)
+        eq_(delay.call_count, 0)
+
+    def test_status_of_started_sync_is_returned(self):
+        self.start_sync(self.package_set, 'task-1')
+        response = self.get_status(self.package_set, 'task-1')
+        eq_(response.status_code, status.HTTP_200_OK)
+        eq_(response.data['state'], 'SUCCESS')
+        eq_(response.data['result'], {'created': [], 'total': 0})
+
+    def test_status_of_sync_of_another_package_set_is_not_found(self):
+        self.start_sync(self.other_package_set, 'task-2')
+        eq_(self.get_status(self.package_set, 'task-2').status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_status_of_unknown_task_is_not_found(self):
+        eq_(self.get_status(self.package_set, 'not-a-sync').status_code, status.HTTP_404_NOT_FOUND)
@@ -1,11 +1,13 @@
-from rest_framework import mixins, viewsets, filters
+from django.http import Http404
+from rest_framework import mixins, viewsets, filters, status
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.decorators import action
 from rest_framework.serializers import Serializer
 from rest_framework.response import Response
 
 from kerckhoff.integrations.serializers import IntegrationSerializer
-from .tasks import sync_gdrive_task
+from kerckhoff.taskqueues.tasks import get_task_result
+from .tasks import is_sync_gdrive_task, start_sync_gdrive_task
 
 from .models import PackageSet, Package
 from .serializers import (
@@ -37,15 +39,33 @@ class PackageSetViewSet(
     @action(methods=["post"], detail=True, serializer_class=Serializer)
     def sync_gdrive(self, request, slug):
         """
-        Imports all packages from the Google Drive folder of a package set
+        Imports all packages from the Google Drive folder of a package set in the background.
+        The result can be polled from `sync_gdrive/<id>` with the returned task id.
         """
-        response = sync_gdrive_task(slug)
-        return Response(response)
+        task_id = start_sync_gdrive_task(self.get_object())
+        return Response({"id": task_id}, status=status.HTTP_202_ACCEPTED)
 
     @action(methods=["post"], detail=True, serializer_class=Serializer)
     def async_sync_gdrive(self, request, slug):
-        task = sync_gdrive_task.delay(slug)
-        return Response({"id": task.id})
+        """
+        Same as `sync_gdrive`, kept for existing clients
+        """
+        return Response({"id": start_sync_gdrive_task(self.get_object())})
+
+    @action(
+        methods=["get"],
+        detail=True,
+        serializer_class=Serializer,
+        url_path=r"sync_gdrive/(?P<task_id>[-\w]+)",
+    )
+    def sync_gdrive_status(self, request, slug, task_id):
+        """
+        Retrieves the state of a Google Drive import, and its result once it has finished.
+        Only the imports started for the package set can be retrieved.
+        """
+        if not is_sync_gdrive_task(self.get_object(), task_id):
+            raise Http404
+        return Response(get_task_result(task_id))
 
     @action(methods=["post"], detail=True, serializer_class=IntegrationSerializer)
     def integration(self, request, slug):
@@ -91,8 +111,13 @@ class PackageViewSet(
 
     @action(methods=["post"], detail=True, serializer_class=Serializer)
     def preview(self, request, **kwargs):
+        """
+        Refreshes the cached contents of a package. Only files that were modified since the
+        last preview are downloaded again, unless `?full=true` is specified.
+        """
         package = self.get_object()
-        package.fetch_cache()
+        full_refresh = request.query_params.get("full", "false").lower() == "true"
+        package.fetch_cache(incremental=not full_refresh)
         serializer = PackageSerializer(package, many=False)
         return Response(serializer.data)
 
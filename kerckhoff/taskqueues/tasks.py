@@ -3,3 +3,14 @@ from celery.result import AsyncResult
 
 def query_result(task_id):
     return AsyncResult(id=task_id).state
+
+
+def get_task_result(task_id) -> dict:
+    """Returns the state of a task, and its result once it has finished"""
+    task = AsyncResult(id=task_id)
+    response = {"id": task_id, "state": task.state, "result": None}
+    if task.successful():
+        response["result"] = task.result
+    elif task.failed():
+        response["result"] = {"error": str(task.result)}
+    return response
@@ -1,12 +1,16 @@
 import logging
-from typing import Tuple
+import threading
+import time
+from typing import Dict, Tuple
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.utils import timezone, dateparse
 from oauthlib.oauth2.rfc6749.errors import OAuth2Error
 from requests import HTTPError
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth2Session
+from urllib3.util.retry import Retry
 from rest_framework.exceptions import APIException
 
 from kerckhoff.users.models import User as AppUser
@@ -19,6 +23,30 @@ logger = logging.getLogger(__name__)
 
 User: AppUser = get_user_model()
 
+# User id -> (access token of the session, session), see get_oauth2_session
+_oauth2_sessions: Dict[int, Tuple[str, OAuth2Session]] = {}
+_oauth2_sessions_lock = threading.Lock()
+
+
+class SharedOAuth2Session(OAuth2Session):
+    """An OAuth2 session which can be used by several threads at once
+
+    When the access token expires, a single thread refreshes it while the others wait
+    and then use the refreshed token.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._refresh_lock = threading.Lock()
+
+    def refresh_token(self, token_url, **kwargs) -> dict:
+        with self._refresh_lock:
+            # Tokens obtained by a refresh have an expiry time set by oauthlib
+            expires_at = (self.token or {}).get("expires_at")
+            if expires_at is not None and expires_at > time.time():
+                return self.token
+            return super().refresh_token(token_url, **kwargs)
+
 
 class GoogleOAuthStrategy(OAuthStrategy):
     """The strategy to handle OAuth for Google
@@ -98,7 +126,8 @@ class GoogleOAuthStrategy(OAuthStrategy):
             raise NoAuthTokenException()
 
         def token_updater(token: dict):
-            token["expires_at"] = timezone.now().timestamp()
+            expires_in = token.get("expires_in", 0)
+            token["expires_at"] = timezone.now().timestamp() + expires_in
             profile.update_auth_information(cls.PROVIDER_KEY, token)
 
         client_id = settings.GOOGLE_OAUTH["CLIENT_ID"]
@@ -114,13 +143,70 @@ class GoogleOAuthStrategy(OAuthStrategy):
             "expires_in": expires_in,
         }
 
-        return OAuth2Session(
+        session = SharedOAuth2Session(
             client_id,
             token=token,
             auto_refresh_kwargs=extra,
             auto_refresh_url=cls.TOKEN_URL,
             token_updater=token_updater,
         )
+        session.mount("https://", cls._create_http_adapter())
+        return session
+
+    @classmethod
+    def get_oauth2_session(cls, user: User) -> OAuth2Session:
+        """Returns the OAuth2 session of a user, shared by every caller in the process
+
+        The session and its connections are reused until the access token of the user is
+        refreshed outside of it, e.g. by another process or by logging in again. Threads
+        using the session at once share a single token refresh.
+        """
+        auth_info: dict = user.userprofile.get_auth_information(cls.PROVIDER_KEY) or {}
+        access_token = auth_info.get("access_token")
+        with _oauth2_sessions_lock:
+            cached = _oauth2_sessions.get(user.pk)
+            if cached is not None and cached[0] == access_token:
+                return cached[1]
+
+        session = cls.create_oauth2_session(user)
+        update_token = session.token_updater
+
+        def token_updater(token: dict):
+            # The session already uses the refreshed token, so it stays valid. Threads
+            # which waited for the refresh get the same token, it is only saved once.
+            with _oauth2_sessions_lock:
+                cached = _oauth2_sessions.get(user.pk)
+                if cached is not None and cached[1] is session:
+                    if cached[0] == token["access_token"]:
+                        return
+                    _oauth2_sessions[user.pk] = (token["access_token"], session)
+            update_token(token)
+
+        session.token_updater = token_updater
+        with _oauth2_sessions_lock:
+            _oauth2_sessions[user.pk] = (access_token, session)
+        return session
+
+    @staticmethod
+    def _create_http_adapter() -> HTTPAdapter:
+        """Creates a connection pool which retries failed requests
+
+        Rate limited requests are not retried here, they are handled by the rate limiter
+        of GoogleDriveOperations.
+        """
+        retry = Retry(
+            total=settings.GOOGLE_OAUTH["HTTP_MAX_RETRIES"],
+            backoff_factor=settings.GOOGLE_OAUTH["HTTP_RETRY_BACKOFF_FACTOR"],
+            status_forcelist=(500, 502, 503, 504),
+            # urllib3 retries any response with a Retry-After header in
+            # RETRY_AFTER_STATUS_CODES, which includes 429, regardless of the forcelist
+            respect_retry_after_header=False,
+            # The last response is returned as is, and handled by the caller
+            raise_on_status=False,
+        )
+        return HTTPAdapter(
+            pool_maxsize=settings.GOOGLE_OAUTH["HTTP_POOL_SIZE"], max_retries=retry
+        )
 
     def _get_profile(self) -> dict:
         try:
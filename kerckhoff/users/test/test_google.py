@@ -0,0 +1,171 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import MagicMock, patch
+
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, override_settings
+from nose.tools import eq_, ok_
+from requests import Session
+from requests_oauthlib import OAuth2Session
+
+from .factories import UserFactory
+from ..auth import google
+from ..auth.google import GoogleOAuthStrategy, SharedOAuth2Session
+
+
+def make_refreshed_token(access_token):
+    return {
+        'access_token': access_token,
+        'refresh_token': 'refresh',
+        'token_type': 'Bearer',
+        'expires_in': 3600,
+        'expires_at': time.time() + 3600,
+    }
+
+
+class TestSharedOAuth2Session(SimpleTestCase):
+
+    def test_expired_token_is_refreshed_once_by_concurrent_requests(self):
+        refreshes = []
+
+        def refresh_token(session, token_url, **kwargs):
+            refreshes.append(token_url)
+            time.sleep(0.05)
+            session.token = make_refreshed_token(f'access-{len(refreshes)}')
+            return session.token
+
+        updater = MagicMock()
+        session = SharedOAuth2Session(
+            'client',
+            token={
+                'access_token': 'old',
+                'refresh_token': 'refresh',
+                'token_type': 'Bearer',
+                'expires_in': -10,
+            },
+            auto_refresh_url='https://example.com/token',
+            token_updater=updater,
+        )
+        with patch.object(OAuth2Session, 'refresh_token', autospec=True, side_effect=refresh_token), \
+                patch.object(Session, 'request', return_value=MagicMock(status_code=200)) as request:
+            threads = [
+                threading.Thread(target=session.get, args=('https://example.com/api',)) for _ in range(5)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        eq_(len(refreshes), 1)
+        eq_(request.call_count, 5)
+        eq_({call[1]['headers']['Authorization'] for call in request.call_args_list}, {'Bearer access-1'})
+
+    def test_valid_token_is_not_refreshed(self):
+        session = SharedOAuth2Session('client', token=make_refreshed_token('current'))
+        with patch.object(OAuth2Session, 'refresh_token') as refresh_token:
+            eq_(session.refresh_token('https://example.com/token')['access_token'], 'current')
+        eq_(refresh_token.call_count, 0)
+
+
+class TestGetOAuth2Session(TestCase):
+
+    def setUp(self):
+        patcher = patch.dict(google._oauth2_sessions, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = UserFactory()
+        self.user.userprofile.update_auth_information(GoogleOAuthStrategy.PROVIDER_KEY, {
+            'access_token': 'access',
+            'refresh_token': 'refresh',
+            'expires_at': time.time() + 3600,
+        })
+
+    def test_session_is_shared_until_the_token_changes(self):
+        session = GoogleOAuthStrategy.get_oauth2_session(self.user)
+        ok_(isinstance(session, SharedOAuth2Session))
+        ok_(GoogleOAuthStrategy.get_oauth2_session(self.user) is session)
+
+        self.user.userprofile.update_auth_information(
+            GoogleOAuthStrategy.PROVIDER_KEY, {'access_token': 'other'}
+        )
+        ok_(GoogleOAuthStrategy.get_oauth2_session(self.user) is not session)
+
+    def test_refreshed_token_is_saved_once(self):
+        session = GoogleOAuthStrategy.get_oauth2_session(self.user)
+        token = make_refreshed_token('refreshed')
+        with patch.object(self.user.userprofile, 'update_auth_information') as update_auth_information:
+            session.token_updater(token)
+            session.token_updater(token)
+        eq_(update_auth_information.call_count, 1)
+        eq_(google._oauth2_sessions[self.user.pk], ('refreshed', session))
+
+    def test_each_user_has_a_session(self):
+        other_user = UserFactory()
+        other_user.userprofile.update_auth_information(GoogleOAuthStrategy.PROVIDER_KEY, {
+            'access_token': 'access',
+            'refresh_token': 'refresh',
+            'expires_at': time.time() + 3600,
+        })
+        ok_(GoogleOAuthStrategy.get_oauth2_session(self.user)
+            is not GoogleOAuthStrategy.get_oauth2_session(other_user))
+
+    def test_sessions_use_a_pooled_retrying_adapter(self):
+        session = GoogleOAuthStrategy.get_oauth2_session(self.user)
+        adapter = session.get_adapter('https://www.googleapis.com/drive')
+        eq_(adapter._pool_maxsize, settings.GOOGLE_OAUTH['HTTP_POOL_SIZE'])
+        eq_(adapter.max_retries.total, settings.GOOGLE_OAUTH['HTTP_MAX_RETRIES'])
+        eq_(adapter.max_retries.backoff_factor, settings.GOOGLE_OAUTH['HTTP_RETRY_BACKOFF_FACTOR'])
+        eq_(set(adapter.max_retries.status_forcelist), {500, 502, 503, 504})
+
+    def test_refreshed_token_is_stored_with_its_expiry(self):
+        session = GoogleOAuthStrategy.get_oauth2_session(self.user)
+        session.token_updater({'access_token': 'refreshed', 'token_type': 'Bearer', 'expires_in': 3600})
+        auth_info = self.user.userprofile.get_auth_information(GoogleOAuthStrategy.PROVIDER_KEY)
+        eq_(auth_info['access_token'], 'refreshed')
+        eq_(auth_info['refresh_token'], 'refresh')
+        ok_(abs(auth_info['expires_at'] - (time.time() + 3600)) < 60)
+        ok_(GoogleOAuthStrategy.get_oauth2_session(self.user) is session)
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    """Answers every GET with the status and headers of the server, and counts them"""
+
+    def do_GET(self):
+        self.server.requests += 1
+        self.send_response(self.server.status)
+        for header, value in self.server.headers.items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(GOOGLE_OAUTH=dict(settings.GOOGLE_OAUTH, HTTP_MAX_RETRIES=2, HTTP_RETRY_BACKOFF_FACTOR=0))
+class TestHttpAdapter(SimpleTestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), StatusHandler)
+        self.server.requests = 0
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def get(self, status, headers=None):
+        self.server.status = status
+        self.server.headers = headers or {}
+        session = Session()
+        session.mount('http://', GoogleOAuthStrategy._create_http_adapter())
+        with session:
+            return session.get(f'http://127.0.0.1:{self.server.server_port}/')
+
+    def test_rate_limited_responses_are_not_retried(self):
+        eq_(self.get(429, {'Retry-After': '0'}).status_code, 429)
+        eq_(self.server.requests, 1)
+
+    def test_server_errors_are_retried(self):
+        eq_(self.get(503, {'Retry-After': '0'}).status_code, 503)
+        eq_(self.server.requests, 3)